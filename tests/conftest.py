@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the vt3d_tools package is used from the source tree
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
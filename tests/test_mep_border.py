@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+from vt3d_tools.mep import BorderDetect
+
+#####################################################
+# the four loops of BorderDetect.Border before vectorization
+#
+def reference_mark(mask):
+    mask = mask.copy()
+    height, width = mask.shape
+    for y in range(0,height):
+        for x in range(1,width-1):
+            if mask[y,x-1]==0 and mask[y,x]==0 and mask[y,x+1]==1:
+                mask[y,x] = 255
+        for x in range(width-2,1,-1):
+            if mask[y,x+1]==0 and mask[y,x]==0 and mask[y,x-1]==1:
+                mask[y,x] = 255
+    for x in range(0,width):
+        for y in range(1,height-1):
+            if mask[y-1,x]==0 and mask[y,x]==0 and mask[y+1,x]==1:
+                mask[y,x] = 255
+        for y in range(height-2,1,-1):
+            if mask[y+1,x]==0 and mask[y,x]==0 and mask[y-1,x]==1:
+                mask[y,x] = 255
+    return mask
+
+def vectorized_mark(mask):
+    return BorderDetect.MarkOutside(BorderDetect.MarkOutside(mask).T).T
+
+def check(mask):
+    mask = np.asarray(mask,dtype=int)
+    assert np.array_equal(vectorized_mark(mask),reference_mark(mask))
+
+def random_masks():
+    rng = np.random.default_rng(0)
+    for i in range(100):
+        height, width = rng.integers(1,40,2)
+        if i % 2 == 0:
+            yield (rng.random((height,width)) < rng.uniform(0.05,0.9)).astype(int)
+        else:
+            blob = ndimage.gaussian_filter(rng.random((height,width)),2)
+            yield (blob > np.median(blob)).astype(int)
+
+@pytest.mark.parametrize('mask',list(random_masks()))
+def test_random_masks(mask):
+    check(mask)
+
+@pytest.mark.parametrize('shape',[(1,1),(2,2),(3,3),(5,8),(12,7)])
+def test_empty_and_full(shape):
+    check(np.zeros(shape,dtype=int))
+    check(np.ones(shape,dtype=int))
+
+def test_3x3():
+    for bits in range(512):
+        check(np.array([ (bits>>i)&1 for i in range(9) ]).reshape(3,3))
+
+def test_one_pixel_wide_bodies():
+    mask = np.zeros((9,11),dtype=int)
+    mask[4,1:10] = 1
+    check(mask)
+    check(mask.T)
+    mask = np.zeros((9,9),dtype=int)
+    mask[np.arange(1,8),np.arange(1,8)] = 1
+    check(mask)
+    mask = np.zeros((7,7),dtype=int)
+    mask[3,3] = 1
+    check(mask)
+    check(np.ones((1,9),dtype=int))
+    check(np.ones((9,1),dtype=int))
+
+def reference_border(x,y):
+    # BorderDetect.Border before vectorization
+    xmin, xmax, ymin, ymax = np.min(x), np.max(x), np.min(y), np.max(y)
+    x = x - xmin + 5
+    y = y - ymin + 5
+    mask = np.zeros((int(ymax-ymin+10),int(xmax-xmin+10)),dtype=int)
+    mask[y,x] = 1
+    mask = ndimage.binary_closing(mask).astype(int)
+    mask = ndimage.binary_opening(mask).astype(int)
+    mask = reference_mark(mask)
+    mask[y,x] = 0
+    y_idx, x_idx = np.nonzero(mask)
+    return y_idx + ymin - 5, x_idx + xmin - 5
+
+@pytest.mark.parametrize('mask',list(random_masks())[:20])
+def test_border_points(mask):
+    y, x = np.nonzero(mask)
+    if len(x) < 1:
+        return
+    x = x + 100
+    y = y + 50
+    expect = reference_border(x,y)
+    border = BorderDetect(x,y).Border()
+    assert np.array_equal(border[0],expect[0]) and np.array_equal(border[1],expect[1])
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+import os
+import warnings
+from vt3d_tools.obj_wrapper import parse_obj, read_obj
+
+#####################################################
+# line by line reference parser
+#
+def reference_obj(text):
+    vectors = []
+    faces = []
+    for line in text.splitlines():
+        fields = line.split('#')[0].split()
+        if len(fields) < 1:
+            continue
+        if fields[0] == 'v':
+            vectors.append([float(x) for x in fields[1:4]])
+        elif fields[0] == 'f':
+            index = [ int(x.split('/')[0]) for x in fields[1:] ]
+            index = [ len(vectors)+x if x < 0 else x-1 for x in index ]
+            for i in range(1,len(index)-1):
+                faces.append([index[0],index[i],index[i+1]])
+    return np.array(vectors,dtype=float).reshape(-1,3), np.array(faces,dtype=np.int64).reshape(-1,3)
+
+def check(text):
+    vectors, faces = parse_obj(text.encode())
+    ref_vectors, ref_faces = reference_obj(text)
+    assert np.allclose(vectors,ref_vectors)
+    assert np.array_equal(faces,ref_faces)
+    return faces
+
+VERTICES = 'v 0 0 0\nv 1 0 0\nv 1 1 0\nv 0 1 0\nv 0 0 1\n'
+
+def test_plain_faces():
+    faces = check(VERTICES+'f 1 2 3\nf 1 3 4\n')
+    assert faces.tolist() == [[0,1,2],[0,2,3]]
+
+@pytest.mark.parametrize('faces',[
+    'f 1/1 2/2 3/3\n',
+    'f 1/1/1 2/2/2 3/3/3\n',
+    'f 1//1 2//2 3//3\n',
+])
+def test_reference_formats(faces):
+    assert check(VERTICES+faces).tolist() == [[0,1,2]]
+
+def test_mixed_formats_between_lines():
+    faces = check(VERTICES+'f 1 2 3\nf 1/1 3/1 4/1\nf 2//5 3//5 5//5\n')
+    assert faces.tolist() == [[0,1,2],[0,2,3],[1,2,4]]
+
+def test_mixed_formats_in_one_line():
+    assert check(VERTICES+'f 1 2/2/2 3/3\n').tolist() == [[0,1,2]]
+
+def test_leading_whitespace():
+    text = '  v 0 0 0\n\tv 1 0 0\n v 1 1 0\nv 0 1 0\n   f 1 2 3\n\t f 1 3 4\n'
+    assert check(text).tolist() == [[0,1,2],[0,2,3]]
+
+def test_polygons_negative_indices_and_comments():
+    text = '# cube corner\n'+VERTICES+'f -5 -4 -3 -2 # quad\nvn 0 0 1\nvt 0 0\n\nf 1 2 5\n'
+    assert check(text).tolist() == [[0,1,2],[0,2,3],[0,1,4]]
+
+def test_empty():
+    for text in ('','\n\n','   \n'):
+        vectors, faces = parse_obj(text.encode())
+        assert vectors.shape == (0,3) and faces.shape == (0,3)
+
+def test_read_obj_cache(tmp_path):
+    objfile = tmp_path/'mesh.obj'
+    objfile.write_text(VERTICES+'f 1 2 3\n')
+    vectors, faces = read_obj(str(objfile))
+    assert os.path.isfile(f'{objfile}.npz')
+    with warnings.catch_warnings():
+        warnings.simplefilter('error',ResourceWarning)
+        cached_vectors, cached_faces = read_obj(str(objfile))
+    assert np.array_equal(cached_vectors,vectors)
+    assert np.array_equal(cached_faces,faces)
+    # a modified OBJ is parsed again
+    objfile.write_text(VERTICES+'f 1 2 3\nf 1 3 4\n')
+    os.utime(objfile,ns=(1,1))
+    assert read_obj(str(objfile))[1].tolist() == [[0,1,2],[0,2,3]]
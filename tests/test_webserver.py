@@ -0,0 +1,62 @@
+import os
+import gzip
+import threading
+import functools
+import http.client
+import pytest
+from http.server import ThreadingHTTPServer
+from vt3d_tools.webserver import parse_range, CORSRequestHandler
+
+@pytest.mark.parametrize('header,expect',[
+    ('bytes=0-99',(0,99)),
+    ('bytes=640-847',(640,847)),
+    ('bytes=900-',(900,999)),
+    ('bytes=-100',(900,999)),
+    ('bytes=-5000',(0,999)),
+    ('bytes=990-2000',(990,999)),
+    ('bytes=1000-1100',()),
+    ('bytes=50-10',()),
+    ('bytes=0-1,5-9',None),
+    ('bytes=-',None),
+    ('bytes=a-b',None),
+    ('items=0-9',None),
+])
+def test_parse_range(header,expect):
+    assert parse_range(header,1000) == expect
+
+@pytest.fixture
+def server(tmp_path):
+    payload = bytes(range(256))*11
+    (tmp_path/'data.bin').write_bytes(payload)
+    (tmp_path/'data.bin.gz').write_bytes(gzip.compress(payload))
+    os.utime(tmp_path/'data.bin.gz',(os.path.getmtime(tmp_path/'data.bin')+10,)*2)
+    handler = functools.partial(CORSRequestHandler,directory=str(tmp_path))
+    httpd = ThreadingHTTPServer(('127.0.0.1',0),handler)
+    thread = threading.Thread(target=httpd.serve_forever,daemon=True)
+    thread.start()
+    yield httpd.server_address[1], payload
+    httpd.shutdown()
+    httpd.server_close()
+
+def fetch(port,headers):
+    conn = http.client.HTTPConnection('127.0.0.1',port)
+    conn.request('GET','/data.bin',headers=headers)
+    resp = conn.getresponse()
+    body = resp.read()
+    conn.close()
+    return resp, body
+
+def test_encoded_sibling_without_range(server):
+    port, payload = server
+    resp, body = fetch(port,{'Accept-Encoding':'gzip'})
+    assert resp.status == 200
+    assert resp.getheader('Content-Encoding') == 'gzip'
+    assert gzip.decompress(body) == payload
+
+def test_range_ignores_encoded_sibling(server):
+    port, payload = server
+    resp, body = fetch(port,{'Accept-Encoding':'gzip, br','Range':'bytes=640-847'})
+    assert resp.status == 206
+    assert resp.getheader('Content-Encoding') is None
+    assert resp.getheader('Content-Range') == f'bytes 640-847/{len(payload)}'
+    assert body == payload[640:848]
@@ -41,6 +41,7 @@ Options:
             --slice_step [default equal to thickness]
             --spatial_key [default 'spatial3D', the keyname of coordinate array in obsm]
             --X [default notset, create cross sections based on p1 only]
+            --backed [keep the h5ad on disk and load only the cells of every slice]
 Example:
     > vt3d AnySlice -i in.h5ad -o test --p0 "0,1,0" --p1 "1,0,0" --p2 "1,1,0"
     > ls
@@ -83,6 +84,7 @@ def anyslice_main(argv:[]):
     slice_gap = thickness
     slice_gap_custom = 0 
     X_section = False
+    backed = False
     #anno_key = 'annotation'
     ##############################################
     # parse parameters
@@ -95,7 +97,8 @@ def anyslice_main(argv:[]):
                                 "spatial_key=",
                                   "slice_num=",
                                  "slice_step=",
-                                  "thickness="])
+                                  "thickness=",
+                                     "backed"])
     except getopt.GetoptError:
         anyslice_usage()
         sys.exit(2)
@@ -118,6 +121,8 @@ def anyslice_main(argv:[]):
             slice_gap_custom=1
         elif opt == "--spatial_key":
             coord_key = arg
+        elif opt == "--backed":
+            backed = True
         elif opt == "--p0" :
             _, p0 = vector_from_str(arg)
         elif opt == "--p1" :
@@ -139,7 +144,7 @@ def anyslice_main(argv:[]):
         anyslice_usage()
         sys.exit(1)
     #load h5ad
-    inh5ad = H5ADWrapper(indata)
+    inh5ad = H5ADWrapper(indata,backed)
     xyzc = inh5ad.getCellXYZC(coord_key,int)
     if X_section:
         xx = p0[0]
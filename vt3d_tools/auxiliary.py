@@ -11,6 +11,7 @@ def Auxiliary_usage():
           BuildGrids            Build grids( continuous model )
           SCoexp                Spatial-related co-expression matrix calculation.
           MeshSub               Filter data by only keep within mesh points. 
+          Prepare               Save a fast-loading copy of h5ad used by all actions.
          """)
 
 
@@ -26,6 +27,7 @@ def Auxiliary_main(argv:[]):
                                            "BuildGrids",
                                            "SCoexp",
                                            "MeshSub",
+                                           "Prepare",
                                                    ):
         Auxiliary_usage()
         exit(1)
@@ -61,6 +63,10 @@ def Auxiliary_main(argv:[]):
         from vt3d_tools.mesh_sub import meshsub_main
         meshsub_main(argv[1:])
         exit(0)
+    elif argv[0] == "Prepare":
+        from vt3d_tools.prepare import prepare_main
+        prepare_main(argv[1:])
+        exit(0)
     else:
         Auxiliary_usage()
         exit(1)
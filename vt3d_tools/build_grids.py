@@ -9,7 +9,7 @@ import anndata as ad
 from sklearn.svm import SVC
 from sklearn.svm import SVR
 from scipy import sparse
-from vt3d_tools.h5ad_wrapper import H5ADWrapper
+from vt3d_tools.h5ad_wrapper import H5ADWrapper, encode_labels, decode_labels
 from vt3d_tools.obj_wrapper import OBJWrapper
 #####################################################
 # Usage:
@@ -89,31 +89,24 @@ def buildgrids_main(argv:[]):
     new_obs['x'] = predict_xyz[:,0]
     new_obs['y'] = predict_xyz[:,1]
     new_obs['z'] = predict_xyz[:,2]
-    new_obs['c'] = np.arange(1,len(new_obs)+1)
-    new_obs['c'] = new_obs.apply(lambda row: f'cell_{row["c"]}',axis=1)
+    new_obs['c'] = 'cell_' + pd.Series(np.arange(1,len(new_obs)+1)).astype(str)
     new_obs = new_obs.set_index('c')
     train_xyzc = inh5ad.getCellXYZA(conf["spatial_key"],float,conf["annotation"])
     train_xyz = train_xyzc[['x','y','z']].to_numpy()
     ###########################################
     # Train celltypes
-    id_label = []
-    label_id = {}
-    for i,l in enumerate(train_xyzc['anno'].unique()):
-        id_label.append(l)
-        label_id[l]=i
-    train_xyzc['label'] = train_xyzc.apply( lambda row: label_id[row['anno']],axis=1)
-    train_id = train_xyzc['label'].to_numpy()
+    train_id, id_label = encode_labels(train_xyzc['anno'].to_numpy(),sort=False)
 
     print(f'predict lables ... ',flush=True)
     predict_id = TrainAndPredict_CellType(train_xyz, train_id, predict_xyz)
     print(f'predict lables done...',flush=True)
-    new_obs[conf["annotation"]] = predict_id
-    new_obs[conf["annotation"]] = new_obs.apply(lambda row : id_label[int(row[conf["annotation"]])],axis=1)
+    new_obs[conf["annotation"]] = decode_labels(predict_id,id_label)
     ###########################################
     # Train genes
     gene_exp = []
-    for gene in conf["genes"]:
-        train_exp = inh5ad.getGeneExp(gene)
+    train_exps = inh5ad.getGenesExp(conf["genes"])
+    for i, gene in enumerate(conf["genes"]):
+        train_exp = train_exps[:,i]
         print(f'predict gene exp for {gene} ...',flush=True)
         predict_exp = TrainAndPredict_GeneExpression(train_xyz, train_exp, predict_xyz)
         print(f'predict gene exp for {gene} done ...',flush=True)
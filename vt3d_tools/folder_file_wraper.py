@@ -3,6 +3,10 @@ import os
 import sys
 import json
 import numpy as np
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 def check_file(filename):
     if not os.path.isfile(filename):
@@ -24,10 +28,106 @@ class int64_encoder(json.JSONEncoder):
             return float(obj)
         return json.JSONEncoder.default(self, obj)
 
+#####################################################
+# streaming json writer
+#
+# numpy arrays are written chunk by chunk with a fixed
+# number format per dtype instead of going through
+# .tolist() and json.dumps. JSONRows(col1,col2,...) writes
+# equal length columns as a list of rows, which keeps int
+# coordinates and float values in their own format.
+# everything else is dumped by orjson if it is installed.
+#
+JSON_CHUNK = 65536
+
+def number_format(dtype):
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iub':
+        return '%d'
+    if dtype.itemsize <= 4:
+        return '%.7g'
+    return '%.10g'
+
+class JSONRows:
+    def __init__(self,*columns):
+        self.columns = [ np.asarray(x) for x in columns ]
+
+def iter_json_rows(columns):
+    if len(columns) < 1 or len(columns[0]) < 1:
+        yield '[]'
+        return
+    rowfmt = '[' + ','.join([ number_format(x.dtype) for x in columns ]) + ']'
+    sep = '['
+    for start in range(0,len(columns[0]),JSON_CHUNK):
+        rows = zip(*[ x[start:start+JSON_CHUNK].tolist() for x in columns ])
+        yield sep + ','.join(map(rowfmt.__mod__,rows))
+        sep = ','
+    yield ']'
+
+def iter_json_array(array):
+    if array.ndim == 2:
+        yield from iter_json_rows(list(array.T))
+        return
+    if len(array) < 1:
+        yield '[]'
+        return
+    fmt = number_format(array.dtype)
+    sep = '['
+    for start in range(0,len(array),JSON_CHUNK):
+        yield sep + ','.join(map(fmt.__mod__,array[start:start+JSON_CHUNK].tolist()))
+        sep = ','
+    yield ']'
+
+def dump_json(data):
+    if orjson is not None:
+        try:
+            return orjson.dumps(data,option=orjson.OPT_SERIALIZE_NUMPY|orjson.OPT_NON_STR_KEYS).decode()
+        except TypeError:
+            pass
+    return json.dumps(data,cls=int64_encoder,separators=(',',':'))
+
+def has_array(data):
+    # lists of plain values are not scanned beyond the first item
+    values = data.values() if isinstance(data,dict) else data
+    for x in values:
+        if isinstance(x,(np.ndarray,JSONRows)):
+            return True
+        if isinstance(x,(dict,list,tuple)):
+            if has_array(x):
+                return True
+        elif not isinstance(data,dict):
+            return False
+    return False
+
+def iter_json(data):
+    if isinstance(data,JSONRows):
+        yield from iter_json_rows(data.columns)
+    elif isinstance(data,np.ndarray) and data.ndim in (1,2):
+        yield from iter_json_array(data)
+    elif isinstance(data,dict) and has_array(data):
+        sep = '{'
+        for key, value in data.items():
+            yield sep + json.dumps(str(key)) + ':'
+            yield from iter_json(value)
+            sep = ','
+        yield '}'
+    elif isinstance(data,(list,tuple)) and has_array(data):
+        sep = '['
+        for value in data:
+            yield sep
+            yield from iter_json(value)
+            sep = ','
+        yield ']'
+    else:
+        yield dump_json(data)
+
+def data2json(data):
+    return ''.join(iter_json(data)).encode()
+
 def savedata2json(data,filename):
-    text = json.dumps(data,cls=int64_encoder)
     textfile = open(filename, "w")
-    textfile.write(text)
+    for text in iter_json(data):
+        textfile.write(text)
     textfile.close()
 
 
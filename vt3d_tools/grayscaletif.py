@@ -26,6 +26,7 @@ Options:
             -o <output prefix>
             -c <conf.json>
             --spatial_key [default 'spatial3D', the keyname of coordinate array in obsm]
+            --backed [keep the expression matrix on disk, only obs and obsm are loaded]
 Example:
         > vt3d Auxiliary GrayScaleTIF -i in.h5ad -o test -c organ.json
         > cat organ.json
@@ -152,9 +153,10 @@ def grayscaletif_main(argv:[]):
     prefix = ''
     conf_file = ''
     coord_key = 'spatial3D'
+    backed = False
 
     try:
-        opts, args = getopt.getopt(argv,"hi:o:c:",["spatial_key=","help"])
+        opts, args = getopt.getopt(argv,"hi:o:c:",["spatial_key=","help","backed"])
     except getopt.GetoptError:
         grayscaletif_usage()
         sys.exit(2)
@@ -170,6 +172,8 @@ def grayscaletif_main(argv:[]):
             inh5data = arg
         elif opt in ("-c",):
             conf_file = arg
+        elif opt == "--backed":
+            backed = True
 
     if inh5data == "" or prefix == ""  or conf_file == "":
         print("Error: incomplete parameters",flush=True)
@@ -203,7 +207,7 @@ def grayscaletif_main(argv:[]):
         print('Error: number of targets must be equal to number of grayvalue in conf.json!',flush=True)       
         sys.exit(3)
     #load h5ad 
-    inh5ad = H5ADWrapper(inh5data)
+    inh5ad = H5ADWrapper(inh5data,backed)
     if not inh5ad.hasAnno(confdata['keyname']):
         print('Error: invalid keyname !',flush=True)       
         sys.exit(3)
@@ -1,11 +1,121 @@
+import os
 import sys
 import numpy as np
 import pandas as pd
 import anndata as ad
+from scipy import sparse
+
+#######################################################
+# categorical encoding of annotation labels
+#
+# encode_labels returns int codes and the label list.
+# Without categories the labels are listed sorted (or in
+# order of appearance when sort=False); with categories the
+# codes index into the given labels and unknown labels get -1.
+######################################################
+def encode_labels(values,categories=None,sort=True):
+    if categories is None:
+        codes, categories = pd.factorize(values,sort=sort)
+        return codes, np.asarray(categories)
+    codes = pd.Categorical(values,categories=categories).codes
+    return codes.astype(int), np.asarray(categories)
+
+def decode_labels(codes,categories):
+    return np.asarray(categories).take(np.asarray(codes,dtype=int))
+
+#######################################################
+# prepared sidecar store
+#
+# vt3d Auxiliary Prepare writes <in.h5ad>.vt3d next to the
+# input: an uncompressed h5ad with categorical obs and a CSC
+# X whose arrays are contiguous datasets, so they can be
+# memory mapped instead of read. The size and mtime of the
+# source are kept in the root attributes and an outdated
+# sidecar is ignored.
+######################################################
+def sidecar_name(h5ad_filename):
+    return f'{h5ad_filename}.vt3d'
+
+def source_stamp(h5ad_filename):
+    stat = os.stat(h5ad_filename)
+    return np.array([stat.st_size,stat.st_mtime_ns],dtype=np.int64)
+
+def find_sidecar(h5ad_filename):
+    import h5py
+    sidecar = sidecar_name(h5ad_filename)
+    if not os.path.isfile(sidecar):
+        return None
+    try:
+        with h5py.File(sidecar,'r') as f:
+            stamp = f.attrs.get('vt3d_source')
+    except OSError:
+        return None
+    if stamp is None or not np.array_equal(stamp,source_stamp(h5ad_filename)):
+        print(f'WARN : ignore outdated {sidecar}, rerun vt3d Auxiliary Prepare to refresh it.',flush=True)
+        return None
+    return sidecar
+
+def write_sidecar(h5ad_filename):
+    import h5py
+    stamp = source_stamp(h5ad_filename)
+    sidecar = sidecar_name(h5ad_filename)
+    data = ad.read_h5ad(h5ad_filename)
+    X = sparse.csc_matrix(data.X)
+    X.sort_indices()
+    data.X = None
+    data.strings_to_categoricals()
+    data.write(f'{sidecar}.tmp')
+    with h5py.File(f'{sidecar}.tmp','a') as f:
+        g = f.create_group('X')
+        g.attrs['encoding-type'] = 'csc_matrix'
+        g.attrs['encoding-version'] = '0.1.0'
+        g.attrs['shape'] = np.array(X.shape,dtype=np.int64)
+        for key in ('data','indices','indptr'):
+            g.create_dataset(key,data=getattr(X,key))
+        f.attrs['vt3d_source'] = stamp
+    os.replace(f'{sidecar}.tmp',sidecar)
+    return sidecar
+
+def mmap_dataset(filename,dataset):
+    offset = dataset.id.get_offset()
+    if offset is None:
+        # empty or chunked dataset
+        return dataset[:]
+    return np.memmap(filename,dtype=dataset.dtype,mode='r',offset=offset,shape=dataset.shape)
+
+def read_sidecar(sidecar):
+    import h5py
+    try:
+        from anndata.io import read_elem
+    except ImportError:
+        from anndata.experimental import read_elem
+    with h5py.File(sidecar,'r') as f:
+        if 'raw' in f:
+            return ad.read_h5ad(sidecar)
+        X = f['X']
+        shape = tuple(X.attrs['shape'])
+        arrays = tuple( mmap_dataset(sidecar,X[key]) for key in ('data','indices','indptr') )
+        elems = { key:read_elem(f[key]) for key in f.keys() if key != 'X' }
+    X = sparse.csc_matrix(arrays,shape=shape)
+    X.has_sorted_indices = True
+    return ad.AnnData(X=X,**elems)
 
 class H5ADWrapper:
-    def __init__(self,h5ad_filename):
-        self.data = ad.read_h5ad(h5ad_filename)
+    def __init__(self,h5ad_filename,backed=False):
+        # backed mode keeps X on disk and reads gene columns on request
+        self.backed = backed
+        # use the prepared sidecar transparently when it is up to date
+        self.sidecar = find_sidecar(h5ad_filename)
+        self.filename = h5ad_filename if self.sidecar is None else self.sidecar
+        if backed:
+            self.data = ad.read_h5ad(self.filename,backed='r')
+        elif self.sidecar is not None:
+            self.data = read_sidecar(self.sidecar)
+        else:
+            self.data = ad.read_h5ad(h5ad_filename)
+        self.csc = None
+        self.h5 = None
+        self.gene_index = None
 
     def getXY(self,key):
         xy = self.data.obsm[key]
@@ -15,9 +125,7 @@ class H5ADWrapper:
         return self.data.obs[key].to_numpy()
 
     def getGene(self,genename):
-        genedata = self.data[:,genename]
-        exp = genedata.X.toarray()
-        return exp
+        return self.getGenesExp([genename])
     #######################################################
     # get xyzv
     ######################################################
@@ -40,24 +148,146 @@ class H5ADWrapper:
         df['anno'] = self.data.obs[obs_key].to_numpy()
         return df 
 
+    def getAnnoCodes(self,obs_key,categories=None,sort=True):
+        return encode_labels(self.data.obs[obs_key].to_numpy(),categories,sort)
+
     def getGeneXYZE(self,genename,exp_cutoff=0,obsm_key='spatial3D',dtype=int):
-        df = self.getBodyXYZ(obsm_key,dtype)
-        genedata = self.data[:,genename]
-        exp = genedata.X.toarray()
-        df['exp'] = exp
-        df = df[df['exp']>exp_cutoff].copy()
-        return df
+        return self.getGenesXYZE([genename],exp_cutoff,obsm_key,dtype)[0]
+
+    def getGenesXYZE(self,genenames,exp_cutoff=0,obsm_key='spatial3D',dtype=int):
+        xyz = self.getBodyXYZ(obsm_key,dtype)
+        exps = self.getGenesExp(genenames)
+        ret = []
+        for i in range(len(genenames)):
+            keep = exps[:,i]>exp_cutoff
+            df = xyz[keep].copy()
+            df['exp'] = exps[keep,i]
+            ret.append(df)
+        return ret
 
     def getGeneExp(self, genename):
-        genedata = self.data[:,genename]
-        exp = genedata.X.toarray()
-        return exp.reshape(-1)
+        return self.getGenesExp([genename])[:,0]
+
+    #######################################################
+    # batch gene access
+    #
+    # return a dense cells x genes matrix, columns in the order
+    # of genenames. In memory mode the columns are cut from a
+    # CSC copy of X that is built once per session, in backed
+    # mode all the columns are read in one pass over the file.
+    ######################################################
+    def getGenesExp(self, genenames):
+        index = self.GeneIndexMap()
+        gids = [ index[x] for x in genenames ]
+        if self.backed:
+            return self.readGeneColumns(gids)
+        if not sparse.issparse(self.data.X):
+            return np.asarray(self.data.X[:,gids])
+        return self.getExprCSC()[:,gids].toarray()
+
+    #######################################################
+    # backed mode: read columns of X through h5py
+    #
+    # dense and csc X are sliced directly, csr X is scanned
+    # in row blocks of about chunk non-zero values so that
+    # memory stays bounded whatever the size of the file.
+    ######################################################
+    def readGeneColumn(self,gid,chunk=1<<24):
+        return self.readGeneColumns([gid],chunk)[:,0]
+
+    def matrixEncoding(self):
+        import h5py
+        if self.h5 is None:
+            self.h5 = h5py.File(self.filename,'r')
+        X = self.h5['X']
+        if isinstance(X,h5py.Dataset):
+            return 'dense'
+        encoding = X.attrs.get('encoding-type',X.attrs.get('h5sparse_format',''))
+        if isinstance(encoding,bytes):
+            encoding = encoding.decode()
+        return encoding
+
+    def readGeneColumns(self,gids,chunk=1<<24):
+        encoding = self.matrixEncoding()
+        X = self.h5['X']
+        n = self.data.n_obs
+        # h5py wants sorted unique column lists
+        uniq, inverse = np.unique(np.asarray(gids,dtype=int),return_inverse=True)
+        if encoding == 'dense':
+            return np.asarray(X[:,uniq])[:,inverse]
+        exps = np.zeros((n,len(uniq)),dtype=X['data'].dtype)
+        if encoding.startswith('csc'):
+            for i,gid in enumerate(uniq):
+                start, end = X['indptr'][gid:gid+2]
+                exps[X['indices'][start:end],i] = X['data'][start:end]
+            return exps[:,inverse]
+        column = np.full(self.data.n_vars,-1,dtype=int)
+        column[uniq] = np.arange(len(uniq))
+        indptr = X['indptr'][:]
+        row = 0
+        while row < n:
+            end = int(np.searchsorted(indptr,indptr[row]+chunk,side='right'))-1
+            end = min(max(end,row+1),n)
+            start, stop = indptr[row], indptr[end]
+            cols = column[X['indices'][start:stop]]
+            hits = np.flatnonzero(cols>=0)
+            if len(hits) > 0:
+                rows = np.searchsorted(indptr,hits+start,side='right')-1
+                exps[rows,cols[hits]] = X['data'][start:stop][hits]
+            row = end
+        return exps[:,inverse]
+
+    #######################################################
+    # column based access for batch gene export
+    ######################################################
+    def getExprCSC(self):
+        # csc_matrix does not copy X when X is already csc
+        if self.csc is None:
+            self.csc = sparse.csc_matrix(self.data.X)
+            self.csc.sort_indices()
+        return self.csc
+
+    def GeneIndexMap(self):
+        if self.gene_index is None:
+            self.gene_index = { x:i for i,x in enumerate(self.data.var.index) }
+        return self.gene_index
+
+    def getGeneSlice(self,genename):
+        # cell indices and values of the cells expressing genename
+        return next(self.getGeneSlices([genename]))[1:]
+
+    def getGeneSlices(self,genenames,cells=1<<26):
+        # yield genename, rows, exps for every gene. In backed mode
+        # the genes are read in blocks of about cells values, so that
+        # a csr X is scanned once per block instead of once per gene.
+        index = self.GeneIndexMap()
+        if not self.backed:
+            csc = self.getExprCSC()
+            for genename in genenames:
+                gid = index[genename]
+                start, end = csc.indptr[gid], csc.indptr[gid+1]
+                rows = csc.indices[start:end]
+                exps = csc.data[start:end]
+                keep = exps > 0
+                yield genename, rows[keep], exps[keep]
+            return
+        dtype = np.int32 if self.data.n_obs < 2**31 else np.int64
+        block = max(1,cells//max(1,self.data.n_obs))
+        for i in range(0,len(genenames),block):
+            names = genenames[i:i+block]
+            exps = self.readGeneColumns([ index[x] for x in names ])
+            for j, genename in enumerate(names):
+                rows = np.flatnonzero(exps[:,j]>0).astype(dtype)
+                yield genename, rows, exps[rows,j]
 
     #######################################################
     # for any slice
     ######################################################
     def extract_and_assign2D(self,cellarray,coord2D,newkey="spatial2D"):
-        tmpdata = self.data[cellarray,:].copy()
+        if self.backed:
+            tmpdata = self.data[cellarray,:].to_memory()
+        else:
+            tmpdata = self.data[cellarray,:].copy()
         tmpdata.obsm[newkey] = coord2D
         return tmpdata
 
@@ -88,16 +318,13 @@ class H5ADWrapper:
         ret['annokeys'] = []
         ret['annomapper'] = {}
         for anno in annos:
-            unique_anno = np.unique(self.data.obs[anno])
+            _, unique_anno = self.getAnnoCodes(anno)
             if len(unique_anno)<1:
                 print("ERROR: invalid annokey : {anno} exit..." )
                 sys.exit(101)
             ret['annokeys'].append(anno)
-            legend2int = {}
-            int2legend = {}
-            for i,key in enumerate(unique_anno):
-                legend2int[key]=i
-                int2legend[i]=key   
+            legend2int = dict(zip(unique_anno,range(len(unique_anno))))
+            int2legend = dict(zip(range(len(unique_anno)),unique_anno))
             ret['annomapper'][f'{anno}_legend2int'] = legend2int
             ret['annomapper'][f'{anno}_int2legend'] = int2legend
         # prepare box-space
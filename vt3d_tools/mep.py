@@ -5,8 +5,6 @@ import json
 import getopt
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 from skimage import io as skio
 from vt3d_tools.h5ad_wrapper import H5ADWrapper
 from vt3d_tools.panel_wrapper import Plane
@@ -49,6 +47,24 @@ class BorderDetect:
         self.x = x 
         self.y = y
 
+    ###################################
+    # mark 255 on every empty pixel that has an empty pixel
+    # before it and a body pixel after it along axis 1, then,
+    # scanning backward, on every still empty pixel that has
+    # a still empty pixel after it and a body pixel before it.
+    @staticmethod
+    def MarkOutside(mask):
+        empty = mask == 0
+        body = mask == 1
+        forward = np.zeros(mask.shape,dtype=bool)
+        forward[:,1:-1] = empty[:,:-2] & empty[:,1:-1] & body[:,2:]
+        empty = empty & ~forward
+        backward = np.zeros(mask.shape,dtype=bool)
+        backward[:,2:-1] = empty[:,3:] & empty[:,2:-1] & body[:,1:-2]
+        mask = mask.copy()
+        mask[forward|backward] = 255
+        return mask
+
     def Border(self):
         xmin = np.min(self.x)
         xmax = np.max(self.x)
@@ -65,26 +81,39 @@ class BorderDetect:
         mask = ndimage.binary_closing(mask).astype(int)
         mask = ndimage.binary_opening(mask).astype(int)
 
-        for y in range(0,height):
-            for x in range(1,width-1):
-                if mask[y,x-1]==0 and mask[y,x]==0 and mask[y,x+1]==1:
-                    mask[y,x] = 255
-            for x in range(width-2,1,-1):
-                if mask[y,x+1]==0 and mask[y,x]==0 and mask[y,x-1]==1:
-                    mask[y,x] = 255
-        for x in range(0,width):
-            for y in range(1,height-1):
-                if mask[y-1,x]==0 and mask[y,x]==0 and mask[y+1,x]==1:
-                    mask[y,x] = 255
-            for y in range(height-2,1,-1):
-                if mask[y+1,x]==0 and mask[y,x]==0 and mask[y-1,x]==1:
-                    mask[y,x] = 255
+        # mark the outside pixels of the body row by row, then column by column
+        mask = self.MarkOutside(mask)
+        mask = self.MarkOutside(mask.T).T
         mask[self.y,self.x] = 0
         (y_idx,x_idx) = np.nonzero(mask)
         y_idx = y_idx + ymin - 5 #switch back to raw coord
         x_idx = x_idx + xmin - 5 #switch back to raw coord
         return y_idx,x_idx
 
+#################################################
+# MaxProjection, bin two axes and reduce the values of
+# every bin to their max in a dense 2D raster. Shared by
+# the body border and the gene MEP of all views.
+#
+class MaxProjection:
+    def __init__(self,u,v,binsize=1):
+        self.u = (np.asarray(u)/binsize).astype(int)
+        self.v = (np.asarray(v)/binsize).astype(int)
+        self.shape = (int(np.max(self.u))+1,int(np.max(self.v))+1)
+
+    # non-empty bins, sorted by u then v
+    def Bins(self):
+        hit = np.zeros(self.shape,dtype=bool)
+        hit[self.u,self.v] = True
+        return np.nonzero(hit)
+
+    def Max(self,values):
+        values = np.asarray(values)
+        raster = np.full(self.shape,np.min(values),dtype=values.dtype)
+        np.maximum.at(raster,(self.u,self.v),values)
+        bins_u, bins_v = self.Bins()
+        return bins_u, bins_v, raster[bins_u,bins_v]
+
 #################################################
 # ROIManager
 #
@@ -153,26 +182,24 @@ class BodyInfo:
         # save final body
         self.body = bd
 
+    #################################
+    # project the body bins on the xcol-ycol plane and detect
+    # the border, xcol is the column and ycol the row of image
+    #
+    def projectBorder(self,xcol,ycol):
+        bins_x, bins_y = MaxProjection(self.body[xcol],self.body[ycol]).Bins()
+        height = int(np.max(bins_y)+2) #right 1 pixel margin
+        width = int(np.max(bins_x)+2)  #right 1 pixel margin
+        y_idx,x_idx = BorderDetect(bins_x,bins_y).Border()
+        scale = self.bin_draw_scale
+        return width*scale, height*scale, len(bins_x)*scale*scale, x_idx*scale, y_idx*scale
+
     #################################
     #  AP = x axis , ML = y axis
     #
-    def calcAPML_border(self):              
-        # agg all z coordinate
-        bd = self.body.groupby(['x', 'y']).agg(z=('z','max')).reset_index()
-        height = int(np.max(bd['y'])+2) #right 1 pixel margin
-        width = int(np.max(bd['x'])+2)  #right 1 pixel margin
-        # get basic infos
-        self.APML_W  = width * self.bin_draw_scale
-        self.APML_H  = height * self.bin_draw_scale
-        self.APML_points_num = len(bd)*self.bin_draw_scale*self.bin_draw_scale
-        # get border dash points
-        graph_matrix = np.zeros((height,width),dtype='uint8')
-        graph_matrix[bd['y'],bd['x']]=1
-        ( body_y, body_x ) = np.nonzero(graph_matrix)
-        y_idx,x_idx = BorderDetect(body_x,body_y).Border()
-        # save final border
-        self.APML_x_idx = x_idx*self.bin_draw_scale
-        self.APML_y_idx = y_idx*self.bin_draw_scale
+    def calcAPML_border(self):
+        ( self.APML_W, self.APML_H, self.APML_points_num,
+          self.APML_x_idx, self.APML_y_idx ) = self.projectBorder('x','y')
 
     def getAPML_num_points(self):
         return self.APML_points_num
@@ -186,23 +213,9 @@ class BodyInfo:
     #################################
     #  AP = x axis , DV = y axis
     #
-    def calcAPDV_border(self):              
-        # agg all y coordinate
-        bd = self.body.groupby(['x', 'z']).agg(y=('y','max')).reset_index()
-        height = int(np.max(bd['z'])+2)
-        width = int(np.max(bd['x'])+2)
-        # get basic infos
-        self.APDV_W  = width * self.bin_draw_scale
-        self.APDV_H  = height * self.bin_draw_scale
-        self.APDV_points_num = len(bd)*self.bin_draw_scale*self.bin_draw_scale
-        # get border dash points
-        graph_matrix = np.zeros((height,width),dtype='uint8')
-        graph_matrix[bd['z'],bd['x']]=1
-        ( body_y, body_x ) = np.nonzero(graph_matrix)
-        y_idx,x_idx = BorderDetect(body_x,body_y).Border()
-        # save final border
-        self.APDV_x_idx = x_idx*self.bin_draw_scale
-        self.APDV_y_idx = y_idx*self.bin_draw_scale
+    def calcAPDV_border(self):
+        ( self.APDV_W, self.APDV_H, self.APDV_points_num,
+          self.APDV_x_idx, self.APDV_y_idx ) = self.projectBorder('x','z')
 
     def getAPDV_num_points(self):
         return self.APDV_points_num
@@ -216,23 +229,9 @@ class BodyInfo:
     #################################
     #  ML = x axis , DV = x axis
     #
-    def calcMLDV_border(self):              
-        # agg all y coordinate
-        bd = self.body.groupby(['y', 'z']).agg(x=('x','max')).reset_index()
-        height = int(np.max(bd['y'])+2)
-        width = int(np.max(bd['z'])+2)
-        # get basic infos
-        self.MLDV_W  = width * self.bin_draw_scale
-        self.MLDV_H  = height * self.bin_draw_scale
-        self.MLDV_points_num = len(bd)*self.bin_draw_scale*self.bin_draw_scale
-        # get border dash points
-        graph_matrix = np.zeros((height,width),dtype='uint8')
-        graph_matrix[bd['y'],bd['z']]=1
-        ( body_y, body_x ) = np.nonzero(graph_matrix)
-        y_idx,x_idx = BorderDetect(body_x,body_y).Border()
-        # save final border
-        self.MLDV_x_idx = x_idx*self.bin_draw_scale
-        self.MLDV_y_idx = y_idx*self.bin_draw_scale
+    def calcMLDV_border(self):
+        ( self.MLDV_W, self.MLDV_H, self.MLDV_points_num,
+          self.MLDV_x_idx, self.MLDV_y_idx ) = self.projectBorder('z','y')
 
     def getMLDV_num_points(self):
         return self.MLDV_points_num
@@ -248,11 +247,11 @@ class Gene3D:
         self.binsize = binsize
 
     def loadExpr(self,inh5,genes,roi):
-        a = []
-        for gene in genes:  #hanle multi files here
-            aa = inh5.getGeneXYZE(gene,0,coord_key,int)
-            if not aa.empty:
-                a.append(aa)
+        # all channel genes are read in one batch
+        self.setExpr(inh5.getGenesXYZE(genes,0,coord_key,int),roi)
+
+    def setExpr(self,xyzes,roi):
+        a = [ aa for aa in xyzes if not aa.empty ]
         if len(a) == 0 :
            self.valid = False   
            return
@@ -266,32 +265,19 @@ class Gene3D:
         self.valid = True
         self.gene_expr = show_data
 
+    def getMIR(self,ucol,vcol):
+        proj = MaxProjection(self.gene_expr[ucol],self.gene_expr[vcol],self.binsize)
+        bins_u, bins_v, value = proj.Max(self.gene_expr['value'])
+        return pd.DataFrame({ucol:bins_u,vcol:bins_v,'value':value})
+
     def getMIR_APML(self):
-        show_data = self.gene_expr.copy()
-        show_data['x'] = show_data['x']/self.binsize
-        show_data['x'] = show_data['x'].astype(int)
-        show_data['y'] = show_data['y']/self.binsize
-        show_data['y'] = show_data['y'].astype(int)
-        show_data = show_data.groupby(['x', 'y']).agg(value=('value', 'max')).reset_index()
-        return show_data
+        return self.getMIR('x','y')
 
     def getMIR_APDV(self):
-        show_data = self.gene_expr.copy()
-        show_data['x'] = show_data['x']/self.binsize
-        show_data['x'] = show_data['x'].astype(int)
-        show_data['z'] = show_data['z']/self.binsize
-        show_data['z'] = show_data['z'].astype(int)
-        show_data = show_data.groupby(['x', 'z']).agg(value=('value', 'max')).reset_index()
-        return show_data
+        return self.getMIR('x','z')
 
     def getMIR_MLDV(self):
-        show_data = self.gene_expr.copy()
-        show_data['y'] = show_data['y']/self.binsize
-        show_data['y'] = show_data['y'].astype(int)
-        show_data['z'] = show_data['z']/self.binsize
-        show_data['z'] = show_data['z'].astype(int)
-        show_data = show_data.groupby(['y', 'z']).agg(value=('value', 'max')).reset_index()
-        return show_data
+        return self.getMIR('y','z')
 
 def GetBodyInfo(inh5,binconf,roi):
     body_binsize, body_scale = binconf.bodyBinConf()
@@ -333,24 +319,37 @@ def GetGeneExpr(inh5,genes,binconf,roi):
     gene_expr.loadExpr(inh5,genes,roi)
     return gene_expr
 
-def FISH_scale(num_points, panel_expr):
-    from sklearn.preprocessing import QuantileTransformer
-    min_value = np.min(panel_expr)
-    max_value = np.percentile(panel_expr,95)
-    num_light_panel=len(panel_expr)
-    temp_list = np.zeros(num_points)
-    temp_list[0:num_light_panel]=panel_expr
-    qt = QuantileTransformer(output_distribution='uniform', random_state=0)
-    temp_list_scale = qt.fit_transform(temp_list.reshape(-1, 1))
-    temp_list_scale = temp_list_scale.reshape(-1)
-    ret_data = panel_expr/max_value  #temp_list_scale[0:num_light_panel]
-    ret_data = ret_data*8
-    ret_data = np.power((np.ones(len(ret_data))*2),ret_data);
-    ret_data [ ret_data >255 ] = 255
-    ret_data = ret_data.astype(int)
-    return ret_data
+#################################################
+# intensity scaling of pseudoFISH and eMEP, every mode maps
+# the max projected values of one view to 0-255
+#
+# log2     : 2^(8*value/p95), the default
+# quantile : rank of value among all body pixels, pixels without
+#            expression count as 0
+# linear   : 255*value/max
+#
+def scale_log2(num_points, values):
+    max_value = np.percentile(values,95)
+    ret_data = np.power(np.full(len(values),2.0),values/max_value*8)
+    ret_data[ ret_data >255 ] = 255
+    return ret_data.astype(int)
+
+def scale_quantile(num_points, values):
+    total = max(num_points,len(values))
+    ranks = np.searchsorted(np.sort(values),values,side='right')+(total-len(values))
+    return (ranks/total*255).astype(int)
+
+def scale_linear(num_points, values):
+    return (values/np.max(values)*255).astype(int)
+
+FISH_scales = { 'log2' : scale_log2, 'quantile' : scale_quantile, 'linear' : scale_linear }
+
+def FISH_scale(num_points, panel_expr, mode='log2'):
+    return FISH_scales[mode](num_points,np.asarray(panel_expr))
 
 def drawRdBu(x,y,e,prefix,W,H,symbolsize,cmap_name="RdYlBu_r"):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     tmp = pd.DataFrame()
     tmp['x'] = x
     tmp['y'] = y
@@ -366,16 +365,65 @@ def drawRdBu(x,y,e,prefix,W,H,symbolsize,cmap_name="RdYlBu_r"):
     plt.savefig(f'{prefix}.pdf',dpi=72)
     plt.close()
 
-def DrawAPDV_RdBu(body_info, expr,prefix,symbolsize,cmap_name):
+#################################################
+# raster backend of cmap mode
+#
+# every bin becomes one pixel whose color is looked up in the
+# colormap directly, no figure is created. The y axis goes up
+# as in the pdf plot and empty bins stay white.
+#
+def get_cmap(cmap_name):
+    import matplotlib
+    try:
+        return matplotlib.colormaps[cmap_name]
+    except AttributeError:
+        # matplotlib < 3.5
+        from matplotlib import cm
+        return cm.get_cmap(cmap_name)
+    except KeyError:
+        # seaborn only palettes are registered by importing seaborn
+        import seaborn
+        return matplotlib.colormaps[cmap_name]
+
+def drawRdBuRaster(x,y,e,prefix,W,H,cmap_name,fmt,legend):
+    x = np.asarray(x,dtype=int)
+    y = np.asarray(y,dtype=int)
+    e = np.asarray(e,dtype=float)
+    W = max(W,int(np.max(x))+1)
+    H = max(H,int(np.max(y))+1)
+    vmin, vmax = np.min(e), np.max(e)
+    norm = (e-vmin)/(vmax-vmin) if vmax > vmin else np.zeros(len(e))
+    cmap = get_cmap(cmap_name)
+    image = np.full((H,W,3),255,dtype='uint8')
+    image[H-1-y,x,:] = (cmap(norm)[:,:3]*255).astype('uint8')
+    skio.imsave(f'{prefix}.{fmt}',image,check_contrast=False)
+    if legend:
+        drawLegend(vmin,vmax,prefix,cmap)
+
+def drawLegend(vmin,vmax,prefix,cmap):
+    import matplotlib
+    from matplotlib import pyplot as plt
+    fig, ax = plt.subplots(figsize=(0.8,3))
+    fig.colorbar(matplotlib.cm.ScalarMappable(norm=matplotlib.colors.Normalize(vmin,vmax),cmap=cmap),cax=ax)
+    fig.savefig(f'{prefix}.legend.png',dpi=72,bbox_inches='tight')
+    plt.close(fig)
+
+def drawCmap(x,y,e,prefix,W,H,symbolsize,cmap_name,fmt='pdf',legend=False):
+    if fmt == 'pdf':
+        drawRdBu(x,y,e,prefix,W,H,symbolsize,cmap_name)
+    else:
+        drawRdBuRaster(x,y,e,prefix,W,H,cmap_name,fmt,legend)
+
+def DrawAPDV_RdBu(body_info, expr,prefix,symbolsize,cmap_name,fmt='pdf',legend=False,scale='log2'):
     W,H = body_info.getAPDV_WH()
     APDV_expr = expr.getMIR_APDV()
     APDV_expr['x'] = APDV_expr['x']
     APDV_expr['z'] = APDV_expr['z']
-    drawRdBu(APDV_expr['x'],APDV_expr['z'],APDV_expr['value'],f'{prefix}.raw',W,H,symbolsize,cmap_name)
-    draw_expr = FISH_scale(body_info.getAPDV_num_points(),APDV_expr['value'])
+    drawCmap(APDV_expr['x'],APDV_expr['z'],APDV_expr['value'],f'{prefix}.raw',W,H,symbolsize,cmap_name,fmt,legend)
+    draw_expr = FISH_scale(body_info.getAPDV_num_points(),APDV_expr['value'],scale)
     draw_expr = draw_expr.astype(float)
     draw_expr = draw_expr / 255.0
-    drawRdBu(APDV_expr['x'],APDV_expr['z'],draw_expr,prefix,W,H,symbolsize,cmap_name)
+    drawCmap(APDV_expr['x'],APDV_expr['z'],draw_expr,prefix,W,H,symbolsize,cmap_name,fmt,legend)
     ret = pd.DataFrame()
     ret['x'] = APDV_expr['x'].to_numpy()
     ret['y'] = APDV_expr['z'].to_numpy()
@@ -383,16 +431,16 @@ def DrawAPDV_RdBu(body_info, expr,prefix,symbolsize,cmap_name):
     ret['eMEP'] = draw_expr
     ret.to_csv(f'{prefix}.result.csv',sep='\t',header=True,index=False)
 
-def DrawMLDV_RdBu(body_info, expr,prefix,symbolsize,cmap_name):
+def DrawMLDV_RdBu(body_info, expr,prefix,symbolsize,cmap_name,fmt='pdf',legend=False,scale='log2'):
     W,H = body_info.getMLDV_WH()
     MLDV_expr = expr.getMIR_MLDV()
     MLDV_expr['y'] = MLDV_expr['y']
     MLDV_expr['z'] = MLDV_expr['z']
-    drawRdBu(MLDV_expr['y'],MLDV_expr['z'],MLDV_expr['value'],f'{prefix}.raw',W,H,symbolsize,cmap_name)
-    draw_expr = FISH_scale(body_info.getMLDV_num_points(),MLDV_expr['value'])
+    drawCmap(MLDV_expr['y'],MLDV_expr['z'],MLDV_expr['value'],f'{prefix}.raw',W,H,symbolsize,cmap_name,fmt,legend)
+    draw_expr = FISH_scale(body_info.getMLDV_num_points(),MLDV_expr['value'],scale)
     draw_expr = draw_expr.astype(float)
     draw_expr = draw_expr / 255.0
-    drawRdBu(MLDV_expr['y'],MLDV_expr['z'],draw_expr,prefix,W,H,symbolsize,cmap_name)
+    drawCmap(MLDV_expr['y'],MLDV_expr['z'],draw_expr,prefix,W,H,symbolsize,cmap_name,fmt,legend)
     ret = pd.DataFrame()
     ret['x'] = MLDV_expr['y'].to_numpy()
     ret['y'] = MLDV_expr['z'].to_numpy()
@@ -400,16 +448,16 @@ def DrawMLDV_RdBu(body_info, expr,prefix,symbolsize,cmap_name):
     ret['eMEP'] = draw_expr
     ret.to_csv(f'{prefix}.result.csv',sep='\t',header=True,index=False)
 
-def DrawAPML_RdBu(body_info, expr,prefix,symsize,cmap_name):
+def DrawAPML_RdBu(body_info, expr,prefix,symsize,cmap_name,fmt='pdf',legend=False,scale='log2'):
     W,H = body_info.getAPML_WH()
     APML_expr = expr.getMIR_APML()
     APML_expr['y'] = APML_expr['y']#//+body_info.bin_draw_scale 
     APML_expr['x'] = APML_expr['x']#//+body_info.bin_draw_scale 
-    drawRdBu(APML_expr['x'],APML_expr['y'],APML_expr['value'],f'{prefix}.raw',W,H,symsize,cmap_name)
-    draw_expr =  FISH_scale(body_info.getAPML_num_points(),APML_expr['value'])
+    drawCmap(APML_expr['x'],APML_expr['y'],APML_expr['value'],f'{prefix}.raw',W,H,symsize,cmap_name,fmt,legend)
+    draw_expr =  FISH_scale(body_info.getAPML_num_points(),APML_expr['value'],scale)
     draw_expr = draw_expr.astype(float)
     draw_expr = draw_expr / 255.0
-    drawRdBu(APML_expr['x'],APML_expr['y'],draw_expr,prefix,W,H,symsize,cmap_name)
+    drawCmap(APML_expr['x'],APML_expr['y'],draw_expr,prefix,W,H,symsize,cmap_name,fmt,legend)
     ret = pd.DataFrame()
     ret['x'] = APML_expr['x'].to_numpy()
     ret['y'] = APML_expr['y'].to_numpy()
@@ -417,13 +465,13 @@ def DrawAPML_RdBu(body_info, expr,prefix,symsize,cmap_name):
     ret['eMEP'] = draw_expr
     ret.to_csv(f'{prefix}.result.csv',sep='\t',header=True,index=False)
 
-def DrawSingleFISH_APML( body_info, expr, colors,prefix ):
+def DrawSingleFISH_APML( body_info, expr, colors,prefix,scale='log2' ):
     W,H = body_info.getAPML_WH()
     draw_array = np.zeros((H,W,3),dtype='uint8')
     APML_expr = expr.getMIR_APML()
     APML_expr['y'] = APML_expr['y']+body_info.bin_draw_scale #shift the 1 pixel margin for border
     APML_expr['x'] = APML_expr['x']+body_info.bin_draw_scale #shift the 1 pixel margin for border
-    draw_expr =  FISH_scale(body_info.getAPML_num_points(),APML_expr['value'])
+    draw_expr =  FISH_scale(body_info.getAPML_num_points(),APML_expr['value'],scale)
     draw_expr = draw_expr.astype(float)
     draw_expr = draw_expr / 255.0
     r_channel = draw_expr * colors[0] 
@@ -434,13 +482,13 @@ def DrawSingleFISH_APML( body_info, expr, colors,prefix ):
     draw_array[APML_expr['y'],APML_expr['x'],2] = b_channel.astype(int)
     return draw_array
 
-def DrawSingleFISH_APDV(body_info, expr, colors, prefix):
+def DrawSingleFISH_APDV(body_info, expr, colors, prefix, scale='log2'):
     W,H = body_info.getAPDV_WH()
     draw_array = np.zeros((H,W,3),dtype='uint8')
     APDV_expr = expr.getMIR_APDV()
     APDV_expr['x'] = APDV_expr['x']+body_info.bin_draw_scale #shift the 1 pixel margin for border
     APDV_expr['z'] = APDV_expr['z']+body_info.bin_draw_scale #shift the 1 pixel margin for border
-    draw_expr = FISH_scale(body_info.getAPDV_num_points(),APDV_expr['value'])
+    draw_expr = FISH_scale(body_info.getAPDV_num_points(),APDV_expr['value'],scale)
     draw_expr = draw_expr.astype(float)
     draw_expr = draw_expr / 255.0
     r_channel = draw_expr * colors[0] 
@@ -451,13 +499,13 @@ def DrawSingleFISH_APDV(body_info, expr, colors, prefix):
     draw_array[APDV_expr['z'],APDV_expr['x'],2] = b_channel.astype(int)
     return draw_array 
 
-def DrawSingleFISH_DVML(body_info, expr, colors, prefix):
+def DrawSingleFISH_DVML(body_info, expr, colors, prefix, scale='log2'):
     W,H = body_info.getMLDV_WH()
     draw_array = np.zeros((H,W,3),dtype='uint8')
     MLDV_expr = expr.getMIR_MLDV()
     MLDV_expr['y'] = MLDV_expr['y']+body_info.bin_draw_scale #shift the 1 pixel margin for border
     MLDV_expr['z'] = MLDV_expr['z']+body_info.bin_draw_scale #shift the 1 pixel margin for border
-    draw_expr = FISH_scale(body_info.getMLDV_num_points(),MLDV_expr['value'])
+    draw_expr = FISH_scale(body_info.getMLDV_num_points(),MLDV_expr['value'],scale)
     draw_expr = draw_expr.astype(float)
     draw_expr = draw_expr / 255.0
     r_channel = draw_expr * colors[0] 
@@ -468,21 +516,72 @@ def DrawSingleFISH_DVML(body_info, expr, colors, prefix):
     draw_array[MLDV_expr['y'],MLDV_expr['z'],2] = b_channel.astype(int)
     return draw_array 
 
-def DrawSingleFISH(view, body_info, gene_expr, color,prefix):
+def DrawSingleFISH(view, body_info, gene_expr, color,prefix,scale='log2'):
     if view == "APML" :
-        return DrawSingleFISH_APML(body_info, gene_expr, color,prefix)
+        return DrawSingleFISH_APML(body_info, gene_expr, color,prefix,scale)
     elif view == "APDV":
-        return DrawSingleFISH_APDV(body_info, gene_expr, color,prefix)
+        return DrawSingleFISH_APDV(body_info, gene_expr, color,prefix,scale)
     elif view == "MLDV":
-        return DrawSingleFISH_DVML(body_info, gene_expr, color,prefix)
+        return DrawSingleFISH_DVML(body_info, gene_expr, color,prefix,scale)
 
-def DrawSingleRdBu(view,body_info, expr,prefix,symsize,cmap_name):
+def DrawSingleRdBu(view,body_info, expr,prefix,symsize,cmap_name,fmt='pdf',legend=False,scale='log2'):
     if view == "APML" :
-        return DrawAPML_RdBu(body_info, expr,prefix,symsize,cmap_name)
+        return DrawAPML_RdBu(body_info, expr,prefix,symsize,cmap_name,fmt,legend,scale)
     elif view == "APDV":
-        return DrawAPDV_RdBu(body_info, expr,prefix,symsize,cmap_name)
+        return DrawAPDV_RdBu(body_info, expr,prefix,symsize,cmap_name,fmt,legend,scale)
     elif view == "MLDV":
-        return DrawMLDV_RdBu(body_info, expr,prefix,symsize,cmap_name)
+        return DrawMLDV_RdBu(body_info, expr,prefix,symsize,cmap_name,fmt,legend,scale)
+
+############################################################################
+# batch cmap mode
+#
+# worker side: the body borders of all views are shipped once per worker
+_batch_body = None
+_batch_conf = None
+
+def init_mep_worker(body_info,views,draw_conf):
+    global _batch_body, _batch_conf
+    _batch_body = body_info
+    _batch_conf = (views,draw_conf)
+
+def render_gene(task):
+    gene, expr, prefix = task
+    views, draw_conf = _batch_conf
+    for view in views:
+        DrawSingleRdBu(view,_batch_body,expr,f'{prefix}.{gene}.{view}',*draw_conf)
+    return gene
+
+def batch_tasks(inh5,genes,binconf,roi,prefix,block=64):
+    # read the genes block by block, skip the genes without expression
+    for i in range(0,len(genes),block):
+        names = genes[i:i+block]
+        for gene, xyze in zip(names,inh5.getGenesXYZE(names,0,coord_key,int)):
+            expr = Gene3D(binconf.geneBinsize())
+            expr.setExpr([xyze],roi)
+            if not expr.valid:
+                print(f'WARN : skip {gene} without expression in ROI',flush=True)
+                continue
+            yield gene, expr, prefix
+
+def RenderBatch(inh5,genes,views,body_info,binconf,roi,prefix,draw_conf,threads):
+    total = len(genes)
+    tasks = batch_tasks(inh5,genes,binconf,roi,prefix)
+    step = max(1, total//20)
+    if threads < 2 or total < 2:
+        init_mep_worker(body_info,views,draw_conf)
+        done = map(render_gene, tasks)
+        pool = None
+    else:
+        from multiprocessing import Pool
+        pool = Pool(min(threads,total), initializer=init_mep_worker,
+                    initargs=(body_info,views,draw_conf))
+        done = pool.imap_unordered(render_gene, tasks, chunksize=4)
+    for i, gene in enumerate(done):
+        if (i+1) % step == 0:
+            print(f'render gene {i+1}/{total} ...',flush=True)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
 ############################################################################
 # common codes for one channel
@@ -503,9 +602,9 @@ class OneChannelData:
             if self.gene_expr.valid == False:
                 self.valid = False
 
-    def GetImage(self, view, body_info, prefix):
+    def GetImage(self, view, body_info, prefix, scale='log2'):
         if self.valid:
-            return DrawSingleFISH(view,body_info,self.gene_expr,self.colors,prefix)
+            return DrawSingleFISH(view,body_info,self.gene_expr,self.colors,prefix,scale)
         else:
             return None
 
@@ -526,6 +625,14 @@ Options:
             [notice: enable --gene will override all pseudoFISH mode parameters]
             --symbolsize [default 10, only used in cmap mode]
             --cmap [default RdBu_r, only used in cmap mode]
+            --cmap_format [default pdf, must be pdf/png/tif, only used in cmap mode]
+                          [png and tif are drawn directly with one pixel per bin]
+            --legend [save a colorbar as <prefix>.legend.png, only used with png/tif]
+
+       batch mode
+            --gene_list <file> [one geneid per line, draw every gene in cmap mode]
+            [notice: enable --gene_list will override --gene and all pseudoFISH mode parameters]
+            -t [default 8, number of processes used in batch mode]
 
        pseudoFISH mode
             -r [geneid that draw in Red(#ff0000) channel]
@@ -538,14 +645,20 @@ Options:
        optional configure options:
             --binsize [default 5]
             --spatial_key [defaut spatial3D, the keyname of coordinate array in obsm]
-            --view [default APML, must be APML/APDV/MLDV]
+            --view [default APML, must be APML/APDV/MLDV or a comma separated list of them]
                    [APML -> xy plane]
                    [APDV -> xz plane]
                    [MLDV -> yz plane]
+                   [notice: each view is saved as <prefix>.<view> if more than one view is given]
             --plane [default '', example: "[[0,0,0],[1,0,0],[1,1,0]]" ]
                     [define any plane by three points]
                     [notice: enable --plane will override --view]
             --drawborder [default 0, must be 1/0]
+            --fish_scale [default log2, must be log2/quantile/linear, intensity scaling of pseudoFISH and eMEP]
+                         [log2     -> 2^(8*value/p95) capped at 255]
+                         [quantile -> rank of value among all body pixels]
+                         [linear   -> 255*value/max]
+            --backed [keep the expression matrix on disk and read only the gene columns in use]
 
        optional ROI options:
             --xmin [default None]
@@ -563,6 +676,12 @@ Example :
 
      #example of cmap mode with assigned plane
      vt3d MEP -i in.h5ad -o test --gene wnt1 --plane '[[0,0,0],[1,0,0],[1,1,0]]'
+
+     #example of batch mode, will generate test.<gene>.<view>.pdf for every gene in genes.txt
+     vt3d MEP -i in.h5ad -o test --gene_list genes.txt --view APML,APDV,MLDV -t 8
+
+     #example of cmap mode with raster output, will generate test.png and test.legend.png
+     vt3d MEP -i in.h5ad -o test --gene wnt1 --cmap_format png --legend
 """)
 
 def saveimage(fname ,draw_matrix):
@@ -584,6 +703,8 @@ def mep_main(argv:[]):
     indata = ''
     prefix = ''
     gene = ''
+    gene_list = ''
+    threads = 8
     r_gene = []
     b_gene = []
     c_gene = []
@@ -604,15 +725,20 @@ def mep_main(argv:[]):
     xmax = ymax = zmax = None
     binsize = 5
     borderbinsize = 20
+    backed = False
     drawborder=0
     symbolsize=10
     cmap_name = "RdYlBu_r"
+    cmap_format = 'pdf'
+    fish_scale = 'log2'
+    legend = False
     ###############################################################################
     # Parse the arguments
     try:
-        opts, args = getopt.getopt(argv,"hi:o:m:r:g:y:b:c:p:",
+        opts, args = getopt.getopt(argv,"hi:o:m:r:g:y:b:c:p:t:",
                                         [ "help",
                                          "gene=",
+                                    "gene_list=",
                                          "view=",
                                          "xmin=",
                                          "ymin=",
@@ -623,9 +749,13 @@ def mep_main(argv:[]):
                                         "plane=",
                                       "binsize=",
                                          "cmap=",
+                                  "cmap_format=",
+                                       "legend",
+                                       "backed",
                                    "symbolsize=",
                                   "spatial_key=",
                                    "drawborder=",
+                                   "fish_scale=",
                                     ])
     except getopt.GetoptError:
         mep_usage()
@@ -636,6 +766,10 @@ def mep_main(argv:[]):
             sys.exit(0)
         elif opt == "--gene":
             gene = arg
+        elif opt == "--gene_list":
+            gene_list = arg
+        elif opt == "-t":
+            threads = int(arg)
         elif opt == "--plane":
             plane = arg
         elif opt == "-i":
@@ -660,8 +794,14 @@ def mep_main(argv:[]):
             symbolsize=int(arg)
         elif opt == "--cmap":
             cmap_name=arg
+        elif opt == "--cmap_format":
+            cmap_format=arg
+        elif opt == "--legend":
+            legend=True
         elif opt == "--drawborder":
             drawborder=int(arg)
+        elif opt == "--fish_scale":
+            fish_scale=arg
         elif opt == "--xmin":
             xmin = int(arg)
         elif opt == "--ymin":
@@ -681,6 +821,8 @@ def mep_main(argv:[]):
             coord_key = arg
         elif opt == "--binsize":
             binsize = int(arg)
+        elif opt == "--backed":
+            backed = True
 
     borderbinsize = binsize
     ###############################################################################
@@ -688,14 +830,26 @@ def mep_main(argv:[]):
     if indata == "" or prefix == "":
         mep_usage()
         sys.exit(3)
+    if not fish_scale in FISH_scales:
+        print(f'ERROR : invalid fish_scale {fish_scale}, must be log2/quantile/linear. exit...',flush=True)
+        sys.exit(3)
+    if not cmap_format in ('pdf','png','tif'):
+        print(f'ERROR : invalid cmap_format {cmap_format}, must be pdf/png/tif. exit...',flush=True)
+        sys.exit(3)
+    views = view.split(',')
+    if plane != '' :
+        views = ['APML']
+    for view in views:
+        if not view in ('APML','APDV','MLDV'):
+            print(f'ERROR : invalid view {view}, must be APML/APDV/MLDV. exit...',flush=True)
+            sys.exit(3)
     #print(f"the drawing view : {view}")
     ###############################################################################
     # Load the data
-    inh5ad = H5ADWrapper(indata)
+    inh5ad = H5ADWrapper(indata,backed)
     if plane != '' :
         xmin = ymin = zmin = None
         xmax = ymax = zmax = None
-        view = 'APML'
         points = json.loads(plane)
         # override spatial3D to new coordinate system now
         plane = Plane(np.array(points[0]),np.array(points[1]),np.array(points[2]))
@@ -707,12 +861,35 @@ def mep_main(argv:[]):
         inh5ad.setXYZ(coord_key,xyzc[['new_x','new_y','new_z']].to_numpy())
 
     roi = ROIManager(xmin,xmax,ymin,ymax,zmin,zmax)
-    binconf = BinConf(view,binsize,borderbinsize)
+    binconf = BinConf(views[0],binsize,borderbinsize)
     ###############################################################################
     # Load the body points 
     print('Loading body now ...',flush=True)
     body_info = GetBodyInfo(inh5ad,binconf,roi)
-    if gene == '':
+    # every view is saved in its own prefix once more than one view is drawn
+    view_prefix = { x : prefix if len(views) == 1 else f'{prefix}.{x}' for x in views }
+    draw_conf = (symbolsize,cmap_name,cmap_format,legend,fish_scale)
+    if gene_list != '':
+        ###############################################################################
+        # Load the gene list and draw all genes in all views
+        genes = []
+        for line in open(gene_list):
+            name = line.strip()
+            if name == '':
+                continue
+            if not inh5ad.hasGene(name):
+                print(f'WARN : skip {name} not in {indata}',flush=True)
+                continue
+            genes.append(name)
+        if len(genes) < 1:
+            print(f'ERROR : no valid gene in {gene_list}. exit...',flush=True)
+            sys.exit(3)
+        # body borders are calculated once per view
+        for view in views:
+            GetBackground(view,body_info,binconf,drawborder)
+        print(f'Rendering {len(genes)} genes in {len(views)} views now ...',flush=True)
+        RenderBatch(inh5ad,genes,views,body_info,binconf,roi,prefix,draw_conf,threads)
+    elif gene == '':
         ###############################################################################
         # Load the gene expr points and draw
         cnames       = [ 'red',   'blue', 'cyan','green','magenta','yellow' ]
@@ -723,20 +900,22 @@ def mep_main(argv:[]):
         print('Loading expression now ...',flush=True)
         for ocd in draw_list:
             ocd.PrepareData(inh5ad,binconf,roi)
-        # get sample border
-        draw_image = GetBackground(view,body_info,binconf,drawborder)
-        for ocd in draw_list:
-            ocd_image = ocd.GetImage(view,body_info,prefix)
-            if ocd_image is None:
-                continue
-            draw_image = mergeImage(draw_image,ocd_image)
-            ocd_image = None
-        saveimage(f'{prefix}.tif',draw_image)
+        for view in views:
+            # get sample border
+            draw_image = GetBackground(view,body_info,binconf,drawborder)
+            for ocd in draw_list:
+                ocd_image = ocd.GetImage(view,body_info,view_prefix[view],fish_scale)
+                if ocd_image is None:
+                    continue
+                draw_image = mergeImage(draw_image,ocd_image)
+                ocd_image = None
+            saveimage(f'{view_prefix[view]}.tif',draw_image)
     else:
-        GetBackground(view,body_info,binconf,drawborder)
         print('Loading expression now ...',flush=True)
         expr = GetGeneExpr(inh5ad,[gene],binconf,roi)
-        DrawSingleRdBu(view,body_info, expr,prefix,symbolsize,cmap_name)
+        for view in views:
+            GetBackground(view,body_info,binconf,drawborder)
+            DrawSingleRdBu(view,body_info, expr,view_prefix[view],*draw_conf)
 
     ###############################################################################
     # Done
@@ -1,8 +1,128 @@
+import os
+import bz2
+import gzip
+import lzma
 import json
 import math
 import numpy as np
 import pandas as pd
+from multiprocessing import Pool
 #from vt3d_tools.is_inside_mesh import IsPointsInsideMesh
+
+#####################################################
+# obj parser
+#
+# read_obj returns vertices (n,3 float) and triangles (m,3 int,
+# 0-based). only v and f records are used; v/vt/vn face syntax,
+# polygons (split as fans) and negative indices are supported.
+# the parsed arrays are cached in <objfile>.npz and reused as long
+# as the size and mtime of the obj file do not change.
+#
+def after_first(flag,starts,group):
+    # bytes at or after the first flag of their group
+    count = np.cumsum(flag,dtype=np.int32)
+    before = count[starts] - flag[starts]
+    return count - before[group] > 0
+
+def parse_numbers(buf,keep,line,nlines,dtype):
+    text = buf[keep]
+    space = (text==32)|(text==9)|(text==10)|(text==13)
+    first = ~space & np.concatenate(([True],space[:-1]))
+    counts = np.bincount(line[keep][first],minlength=nlines)
+    values = np.fromstring(text.tobytes(),dtype=dtype,sep=' ')
+    return values, counts
+
+def parse_obj(data):
+    buf = np.frombuffer(data,dtype=np.uint8).copy()
+    if len(buf) < 1:
+        return np.zeros((0,3)), np.zeros((0,3),dtype=np.int64)
+    newline = buf == 10
+    line = np.cumsum(newline,dtype=np.int32) - newline
+    starts = np.concatenate(([0],np.flatnonzero(newline)+1))[:line[-1]+1]
+    nlines = len(starts)
+    # records are detected at the first non blank byte of each line
+    heads = starts.copy()
+    indent = (buf[starts]==32)|(buf[starts]==9)
+    if indent.any():
+        filled = np.flatnonzero((buf!=32)&(buf!=9))
+        if len(filled) < 1:
+            return np.zeros((0,3)), np.zeros((0,3),dtype=np.int64)
+        heads[indent] = filled[np.minimum(np.searchsorted(filled,starts[indent]),len(filled)-1)]
+    second = buf[np.minimum(heads+1,len(buf)-1)]
+    blank = ((second==32)|(second==9)) & (line[heads]==np.arange(nlines))
+    is_v = (buf[heads]==ord('v')) & blank
+    is_f = (buf[heads]==ord('f')) & blank
+    buf[heads[is_v|is_f]] = 32
+    keep = np.ones(len(buf),dtype=bool)
+    comment = buf == ord('#')
+    if comment.sum() > (buf[heads]==ord('#')).sum():
+        keep = ~after_first(comment,starts,line)
+    # vertices, extra components (w or colors) are ignored
+    values, counts = parse_numbers(buf,keep&is_v[line],line,nlines,float)
+    counts = counts[is_v]
+    offsets = np.cumsum(counts) - counts
+    vectors = values[offsets[:,None]+np.arange(3)]
+    # faces, keep only the vertex index of v/vt/vn: every byte of
+    # a face token from its first slash on is blanked
+    fkeep = keep & is_f[line]
+    fbytes = np.flatnonzero(fkeep)
+    text = buf[fbytes]
+    slash = text == ord('/')
+    if slash.any():
+        space = (text==32)|(text==9)|(text==10)|(text==13)
+        tstart = ~space & np.concatenate(([True],space[:-1]))
+        token = np.maximum(np.cumsum(tstart,dtype=np.int32)-1,0)
+        buf[fbytes[after_first(slash,np.flatnonzero(tstart),token) & ~space]] = 32
+    index, counts = parse_numbers(buf,fkeep,line,nlines,np.int64)
+    counts = counts[is_f]
+    # negative indices count back from the last vertex read so far
+    vbefore = np.repeat(np.cumsum(is_v)[is_f],counts)
+    index = np.where(index<0,vbefore+index,index-1)
+    # split polygons into triangle fans
+    ntris = np.maximum(counts-2,0)
+    first = np.repeat(np.cumsum(counts)-counts,ntris)
+    local = np.arange(ntris.sum()) - np.repeat(np.cumsum(ntris)-ntris,ntris) + 1
+    faces = np.column_stack((index[first],index[first+local],index[first+local+1]))
+    return vectors, faces
+
+def read_obj(objfile):
+    stat = os.stat(objfile)
+    source = np.array([stat.st_size,stat.st_mtime_ns],dtype=np.int64)
+    sidecar = f'{objfile}.npz'
+    if os.path.isfile(sidecar):
+        try:
+            with np.load(sidecar) as cache:
+                if np.array_equal(cache['source'],source):
+                    return cache['vectors'], cache['faces']
+        except (OSError,ValueError,KeyError):
+            pass
+    opener = {'.gz':gzip.open,'.bz2':bz2.open,'.xz':lzma.open}.get(os.path.splitext(objfile)[1],open)
+    with opener(objfile,'rb') as objdata:
+        vectors, faces = parse_obj(objdata.read())
+    try:
+        np.savez(f'{sidecar}.tmp.npz',vectors=vectors,faces=faces,source=source)
+        os.replace(f'{sidecar}.tmp.npz',sidecar)
+    except OSError:
+        pass
+    return vectors, faces
+
+#####################################################
+# quadric decimation by pyvista (optional dependency)
+#
+def decimate_mesh(vectors,faces,target_faces):
+    vectors = np.asarray(vectors,dtype=float)
+    faces = np.asarray(faces).astype(np.int64)
+    if len(faces) <= target_faces:
+        return vectors, faces
+    import pyvista as pv
+    # merge duplicated vertices and drop degenerate triangles first
+    vectors, inverse = np.unique(vectors,axis=0,return_inverse=True)
+    faces = inverse.reshape(-1)[faces]
+    faces = faces[(faces[:,0]!=faces[:,1])&(faces[:,1]!=faces[:,2])&(faces[:,0]!=faces[:,2])]
+    cells = np.column_stack((np.full(len(faces),3),faces)).reshape(-1)
+    mesh = pv.PolyData(vectors,cells)
+    mesh = mesh.decimate(1.0-target_faces/len(faces)).triangulate()
+    return np.asarray(mesh.points,dtype=float), mesh.faces.reshape(-1,4)[:,1:]
 class Mesh:
     def __init__(self,vs,fs):
         self.vectors = vs.to_numpy()
@@ -122,77 +242,75 @@ class OBJWrapper:
         vectors['z'] = vectors['z'] + self.zmin 
         return vectors
 
-    def load_mesh(self, objfile):
-        cache = pd.read_csv(objfile, sep='\s+',header=None, compression='infer', comment='#',low_memory=False)
-        cache.columns = ['type','v1','v2','v3']
-        vectors = cache[cache['type'] == 'v'].copy()
-        vectors = vectors[['v1','v2','v3']].copy()
-        vectors.columns = ['x','y','z']
+    def to_frames(self, vectors, faces):
+        vectors = pd.DataFrame(data=vectors,columns=['x','y','z'])
         vectors = self.reset_coord(vectors)
-        faces = cache[cache['type'] == 'f'].copy()
-        if faces.dtypes['v1'] == object:
-            faces['i'] = faces.apply(lambda row: int(row['v1'].split('/')[0])-1, axis=1)
-            faces['j'] = faces.apply(lambda row: int(row['v2'].split('/')[0])-1, axis=1)
-            faces['k'] = faces.apply(lambda row: int(row['v3'].split('/')[0])-1, axis=1)
-        else:
-            faces['i'] = faces['v1'] -1
-            faces['j'] = faces['v2'] -1 
-            faces['k'] = faces['v3'] -1
-        faces = faces[['i','j','k']].copy()
+        faces = pd.DataFrame(data=faces,columns=['i','j','k'])
+        return vectors, faces
+
+    def read_mesh(self, objfile):
+        vectors, faces = read_obj(objfile)
+        return self.to_frames(vectors,faces)
+
+    def load_mesh(self, objfile):
+        vectors, faces = self.read_mesh(objfile)
         return Mesh(vectors,faces)
 
     def add_mesh(self, organname, objfile):
-        cache = pd.read_csv(objfile, sep='\s+',header=None, compression='infer', comment='#',low_memory=False)
-        cache.columns = ['type','v1','v2','v3']
-        vectors = cache[cache['type'] == 'v'].copy()
-        vectors = vectors[['v1','v2','v3']].copy()
-        vectors.columns = ['x','y','z']
-        vectors = self.reset_coord(vectors)
-        xmin = vectors['x'].min();
-        xmax = vectors['x'].max();
-        ymin = vectors['y'].min();
-        ymax = vectors['y'].max();
-        zmin = vectors['z'].min();
-        zmax = vectors['z'].max();
-        if len(self.data[0])==0:
-            self.mesh_xmin = xmin
-            self.mesh_xmax = xmax
-            self.mesh_ymin = ymin
-            self.mesh_ymax = ymax
-            self.mesh_zmin = zmin
-            self.mesh_zmax = zmax
-        else:
-            if xmin < self.mesh_xmin :
-                self.mesh_xmin = xmin
-            if ymin < self.mesh_ymin :
-                self.mesh_ymin = ymin
-            if zmin < self.mesh_zmin :
-                self.mesh_zmin = zmin
-            if xmax > self.mesh_xmax :
-                self.mesh_xmax = xmax
-            if ymax > self.mesh_ymax :
-                self.mesh_ymax = ymax
-            if zmax > self.mesh_zmax :
-                self.mesh_zmax = zmax
-
-        faces = cache[cache['type'] == 'f'].copy()
-        if faces.dtypes['v1'] == object:
-            faces['i'] = faces.apply(lambda row: int(row['v1'].split('/')[0])-1, axis=1)
-            faces['j'] = faces.apply(lambda row: int(row['v2'].split('/')[0])-1, axis=1)
-            faces['k'] = faces.apply(lambda row: int(row['v3'].split('/')[0])-1, axis=1)
+        vectors, faces = self.read_mesh(objfile)
+        self.append_mesh(organname,vectors,faces)
+        self.merge_boxes()
+
+    def add_meshes(self, meshes, threads=8):
+        # meshes: {organname : objfile}, parsed in parallel, box merged once
+        names = list(meshes)
+        objfiles = [ meshes[x] for x in names ]
+        if threads > 1 and len(objfiles) > 1:
+            with Pool(min(threads,len(objfiles))) as pool:
+                results = pool.map(read_obj,objfiles)
         else:
-            faces['i'] = faces['v1'] -1
-            faces['j'] = faces['v2'] -1 
-            faces['k'] = faces['v3'] -1
-        faces = faces[['i','j','k']].copy()
+            results = [ read_obj(x) for x in objfiles ]
+        for organname, (vectors, faces) in zip(names,results):
+            self.append_mesh(organname,*self.to_frames(vectors,faces))
+        self.merge_boxes()
 
+    def append_mesh(self, organname, vectors, faces):
         self.data[0].append(organname)
-        self.data[1].append(vectors.to_numpy().tolist())
-        self.data[2].append(faces.to_numpy().tolist())
+        self.data[1].append(vectors.to_numpy())
+        self.data[2].append(faces.to_numpy())
+
+    def merge_boxes(self):
+        if len(self.data[1]) < 1:
+            return
+        mins = np.min([ x.min(axis=0) for x in self.data[1] if len(x) > 0 ],axis=0)
+        maxs = np.max([ x.max(axis=0) for x in self.data[1] if len(x) > 0 ],axis=0)
+        self.mesh_xmin, self.mesh_ymin, self.mesh_zmin = mins.tolist()
+        self.mesh_xmax, self.mesh_ymax, self.mesh_zmax = maxs.tolist()
 
     def get_data(self):
         return self.data
 
+    def get_lod_data(self,target_faces):
+        data = [self.data[0],[],[]]
+        for vectors, faces in zip(self.data[1],self.data[2]):
+            vectors, faces = decimate_mesh(vectors,faces,target_faces)
+            data[1].append(vectors)
+            data[2].append(faces)
+        return data
+
+    def get_box(self):
+        return { 'xmin': self.mesh_xmin, 'xmax': self.mesh_xmax,
+                 'ymin': self.mesh_ymin, 'ymax': self.mesh_ymax,
+                 'zmin': self.mesh_zmin, 'zmax': self.mesh_zmax }
+
+    def set_box(self,box):
+        self.mesh_xmin = box['xmin']
+        self.mesh_xmax = box['xmax']
+        self.mesh_ymin = box['ymin']
+        self.mesh_ymax = box['ymax']
+        self.mesh_zmin = box['zmin']
+        self.mesh_zmax = box['zmax']
+
     def update_summary(self,summary):
         ret = summary
         if self.mesh_xmin < ret['box']['xmin']:
@@ -18,6 +18,7 @@ Options:
             -o <output prefix>
             --spatial_key [default 'spatial3D', the keyname of coordinate in obsm]
             --model_json [default None, the model.json]
+            -t [number of processes used to load meshes, default 8]
 
 Notice: data is priceless, no replace mode supported! 
 
@@ -43,8 +44,9 @@ def pca3d_main(argv:[]):
     prefix = ''
     spatial_key = 'spatial3D'
     model_json = ''
+    threads = 8
     try:
-        opts, args = getopt.getopt(argv,"hi:o:",["help","spatial_key=","model_json="])
+        opts, args = getopt.getopt(argv,"hi:o:t:",["help","spatial_key=","model_json="])
     except getopt.GetoptError:
         pca3d_usage()
         sys.exit(2)
@@ -60,6 +62,8 @@ def pca3d_main(argv:[]):
             spatial_key = arg
         elif opt in ("--model_json"):
             model_json = arg
+        elif opt in ("-t"):
+            threads = int(arg)
 
     # sanity check
     if infile == '' or prefix == '' or spatial_key == '':
@@ -78,7 +82,6 @@ def pca3d_main(argv:[]):
         if len(confdata['Meshes'])>1:
             coord_file = confdata['mesh_coord']
             meshes = OBJWrapper(coord_file)
-            for meshname in confdata['Meshes']:
-                meshes.add_mesh(meshname,confdata['Meshes'][meshname])
+            meshes.add_meshes(confdata['Meshes'],threads)
             meshes.fitpca(pca)
             meshes.toobj(prefix)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+import sys
+import getopt
+import time
+from vt3d_tools.h5ad_wrapper import write_sidecar
+#####################################################
+# Usage
+#
+def prepare_usage():
+    print("""
+Usage : vt3d Auxiliary Prepare [options]
+
+Options:
+       required options:
+            -i <input.h5ad> [can be given several times]
+
+Notice: the fast-loading copy is saved as <input.h5ad>.vt3d and
+        used automatically by all vt3d actions that read <input.h5ad>.
+        It is ignored once <input.h5ad> is modified, rerun Prepare then.
+
+Example:
+        > vt3d Auxiliary Prepare -i in.h5ad
+        > vt3d MEP -i in.h5ad -o test --gene wnt1 --view APML
+""", flush=True)
+
+#####################################################
+# main pipe
+#
+def prepare_main(argv:[]):
+    #######################################
+    # default parameter value
+    infiles = []
+    try:
+        opts, args = getopt.getopt(argv,"hi:",["help"])
+    except getopt.GetoptError:
+        prepare_usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ('-h' ,'--help'):
+            prepare_usage()
+            sys.exit(0)
+        elif opt in ("-i"):
+            infiles.append(arg)
+
+    # sanity check
+    if len(infiles) == 0:
+        prepare_usage()
+        sys.exit(0)
+    for infile in infiles:
+        print(f'Prepare {infile} ...',flush=True)
+        start = time.time()
+        sidecar = write_sidecar(infile)
+        print(f'Prepare {infile} done, saved {sidecar} in {time.time()-start:.1f}s',flush=True)
+    print('__ALL DONE__',flush=True)
@@ -177,6 +177,7 @@ Options:
     --spatial_key [default 'spatial3D', the keyname of coordinate in obsm]
     --sigma [sigma of RBF kernel, default 15]
     --genes [default None, file that contain target gene list. if None, all gene used]
+    --backed [keep the h5ad on disk and load only the genes in the gene list]
 
 Notice: too much genes will lead to huge memory cost and dist cost.
 """, flush=True)
@@ -192,8 +193,9 @@ def scoexp_main(argv:[]):
     gene_file = None
     sigma = 15
     spatial_key = 'spatial3D'
+    backed = False
     try:
-        opts, args = getopt.getopt(argv,"hi:o:",["help","spatial_key=","gene_file=", "sigma="])
+        opts, args = getopt.getopt(argv,"hi:o:",["help","spatial_key=","gene_file=", "sigma=", "backed"])
     except getopt.GetoptError:
         scoexp_usage()
         sys.exit(2)
@@ -209,16 +211,24 @@ def scoexp_main(argv:[]):
             spatial_key = arg
         elif opt in ("--gene_file"):
             gene_file = arg
+        elif opt == "--backed":
+            backed = True
 
     # sanity check
     if infile == '' or prefix == '' or spatial_key == '':
         scoexp_usage()
         sys.exit(0)
-    adata = ad.read_h5ad(infile)
     if not gene_file is None:
         genes = np.loadtxt(gene_file,dtype='str').tolist()
     else:
         genes = []
+    if backed:
+        adata = ad.read_h5ad(infile,backed='r')
+        if len(genes) > 1:
+            adata = adata[:,adata.var.index.isin(genes)]
+        adata = adata.to_memory()
+    else:
+        adata = ad.read_h5ad(infile)
     ret = scoexp(adata,spatial_key,sigma,genes)
     ret.to_csv(f'{prefix}.csv',sep='\t',header=True,index=False)
     printJsonPerGene(ret)
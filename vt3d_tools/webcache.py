@@ -3,11 +3,13 @@ import os
 import sys
 import shutil
 import json
+import hashlib
 import getopt
 import numpy as np
 import pandas as pd
 from vt3d_tools.h5ad_wrapper import H5ADWrapper
-from vt3d_tools.obj_wrapper import OBJWrapper
+from vt3d_tools.obj_wrapper import OBJWrapper, decimate_mesh
+from vt3d_tools.folder_file_wraper import savedata2json, data2json, JSONRows
 
 def check_file(filename):
     if not os.path.isfile(filename):
@@ -21,20 +23,500 @@ def create_folder(foldername):
     except FileExistsError:
         print(f'cache folder -- {foldername} already exists, reuse it now....')
 
-class int64_encoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.int64):
-            return int(obj)
-        if isinstance(obj, np.float32):
-            return float(obj)
-        return json.JSONEncoder.default(self, obj)
-
-def savedata2json(data,filename):
-    text = json.dumps(data,cls=int64_encoder)
-    textfile = open(filename, "w")
-    textfile.write(text)
-    textfile.close()
-    
+#####################################################
+# binary columnar payload
+#
+# layout of one .bin file (all little-endian):
+#   uint32          length of the json header in bytes (padding included)
+#   json header     {"count":n,"columns":[{"name","dtype","offset"},...]}
+#                   padded by spaces so that column data starts 8-byte aligned
+#   column data     one typed array per column, each padded to 8 bytes,
+#                   offsets are relative to the first byte after the header
+#
+def data2bin(columns):
+    header = {'count':0, 'columns':[]}
+    arrays = []
+    offset = 0
+    for name, array, *attrs in columns:
+        array = np.ascontiguousarray(array,dtype=np.dtype(array.dtype).newbyteorder('<'))
+        header['count'] = len(array)
+        column = {'name':name,'dtype':array.dtype.name,'offset':offset}
+        for attr in attrs:
+            column.update(attr)
+        header['columns'].append(column)
+        arrays.append(array)
+        offset += (array.nbytes+7)//8*8
+    text = json.dumps(header).encode()
+    text = text + b' '*((-4-len(text))%8)
+    chunks = [np.uint32(len(text)).astype('<u4').tobytes(), text]
+    for array in arrays:
+        chunks.append(array.tobytes())
+        chunks.append(b'\0'*((-array.nbytes)%8))
+    return b''.join(chunks)
+
+def savedata2bin(columns,filename):
+    binfile = open(filename, "wb")
+    binfile.write(data2bin(columns))
+    binfile.close()
+
+#####################################################
+# quantization of bin files
+#
+# coord_step > 0 : x,y,z are stored as uint16 grid indices,
+#                  value = base + q * scale, scale = coord_step,
+#                  base = grid origin (box min), error <= step/2.
+# exp_bits 8/16  : expression is stored as uint8/uint16 per file,
+#                  value = base + q * scale, base = min(exp),
+#                  scale = (max-min)/(2^bits-1), error <= scale/2.
+#
+def quantize(values,base,scale,dtype):
+    if scale <= 0:
+        return np.zeros(len(values),dtype=dtype)
+    q = np.rint((values-base)/scale)
+    return np.clip(q,0,np.iinfo(dtype).max).astype(dtype)
+
+def coord_columns(xyz,conf=None):
+    if conf is not None and conf.coord_step > 0:
+        step = conf.coord_step
+        return [ (name,quantize(xyz[:,i],conf.grid_origin[i],step,'uint16'),
+                  {'scale':step,'base':float(conf.grid_origin[i])})
+                 for i, name in enumerate(('x','y','z')) ]
+    if np.issubdtype(xyz.dtype,np.integer):
+        xyz = xyz.astype('int32')
+    else:
+        xyz = xyz.astype('float32')
+    return [('x',xyz[:,0]),('y',xyz[:,1]),('z',xyz[:,2])]
+
+def annoid_column(annoids):
+    if np.max(annoids,initial=0) < 65536:
+        annoids = annoids.astype('uint16')
+    else:
+        annoids = annoids.astype('uint32')
+    return [('annoid',annoids)]
+
+def delta_column(rows):
+    deltas = np.diff(rows,prepend=0)
+    if np.max(deltas,initial=0) < 65536:
+        deltas = deltas.astype('uint16')
+    else:
+        deltas = deltas.astype('uint32')
+    return [('delta',deltas)]
+
+def exp_column(exps,conf=None):
+    if conf is not None and conf.exp_bits > 0:
+        dtype = 'uint8' if conf.exp_bits == 8 else 'uint16'
+        base, scale = 0.0, 0.0
+        if len(exps) > 0:
+            base = float(np.min(exps))
+            scale = (float(np.max(exps))-base)/np.iinfo(dtype).max
+        return [('exp',quantize(exps,base,scale,dtype),{'scale':scale,'base':base})]
+    return [('exp',exps.astype('float32'))]
+
+#####################################################
+# packed meshes
+#
+# Mesh/<name>.bin uses the bin layout with two columns that
+# carry their own count and components:
+#   position : x,y,z of every unique vertex, float32
+#              (uint16 with per-axis scale/base if quantized)
+#   index    : i,j,k of every triangle, uint32 (uint16 if it fits)
+# mesh.json lists the mesh files and the mesh box.
+# Entries of <reuse> are meshes whose files are up-to-date, they are
+# listed again without being rewritten.
+#
+# mesh lods: target triangle counts of quadric-decimated copies,
+#            written as Mesh/<name>.lod<count>.bin (or
+#            meshes.lod<count>.json), coarse first.
+#
+def mesh_columns(vectors,faces,quantized=False):
+    vectors, inverse = np.unique(vectors,axis=0,return_inverse=True)
+    faces = inverse.reshape(-1)[faces.astype(int)]
+    position = {'count':len(vectors),'components':3}
+    if quantized:
+        base = vectors.min(axis=0)
+        scale = (vectors.max(axis=0)-base)/65535
+        vectors = np.column_stack([ quantize(vectors[:,i],base[i],scale[i],'uint16') for i in range(3) ])
+        position.update({'scale':scale.tolist(),'base':base.tolist()})
+    else:
+        vectors = vectors.astype('float32')
+    if len(vectors) < 65536:
+        faces = faces.astype('uint16')
+    else:
+        faces = faces.astype('uint32')
+    return [('position',vectors,position),('index',faces,{'count':len(faces),'components':3})]
+
+def save_mesh(vectors,faces,prefix,filename,quantized=False):
+    columns = mesh_columns(np.asarray(vectors),np.asarray(faces),quantized)
+    savedata2bin(columns,f'{prefix}/{filename}')
+    return {'url':filename,
+            'vertices':columns[0][2]['count'],
+            'faces':columns[1][2]['count'],
+            'bytes':os.path.getsize(f'{prefix}/{filename}')}
+
+def save_meshes(meshes,prefix,quantized=False,lods=[],reuse={}):
+    index = {'meshes':[],'box':meshes.get_box()}
+    for name, vectors, faces in zip(*meshes.get_data()):
+        if name in reuse:
+            print(f'Mesh/{name}.bin is up-to-date, skip ...',flush=True)
+            index['meshes'].append(reuse[name])
+            continue
+        entry = {'name':name}
+        entry.update(save_mesh(vectors,faces,prefix,f'Mesh/{name}.bin',quantized))
+        entry['lods'] = []
+        for lod in lods:
+            lod_vectors, lod_faces = decimate_mesh(vectors,faces,lod)
+            entry['lods'].append(save_mesh(lod_vectors,lod_faces,prefix,f'Mesh/{name}.lod{lod}.bin',quantized))
+        index['meshes'].append(entry)
+    savedata2json(index,f'{prefix}/mesh.json')
+
+#####################################################
+# cache layout
+#
+# full  : every Anno/Gene file carries x,y,z of its cells.
+# index : coords.<fmt> holds x,y,z of all cells once,
+#         Anno files only hold the annoid of every cell in coords order,
+#         Gene files only hold the sorted cell indices (delta-encoded)
+#         and the expression values of expressed cells.
+#
+# lod   : voxel sizes of the coarse levels written next to every
+#         Anno/Gene file as <name>.lod<size>.<fmt>, coarse first.
+#
+# octree: leaf id of every cell, every Anno/Gene file gets a chunked copy
+#         <name>.chunks.<fmt> grouped by leaf plus <name>.octree.json.
+#
+# coord_step/exp_bits: quantization of bin files, see above.
+class CacheConf:
+    def __init__(self,fmt='json',layout='full',lods=[],coord_step=0,exp_bits=0):
+        self.fmt = fmt
+        self.layout = layout
+        self.lods = sorted(lods,reverse=True)
+        self.origin = None
+        self.octree = None
+        self.coord_step = coord_step
+        self.exp_bits = exp_bits
+        self.grid_origin = None
+
+    def set_grid(self,xyz,box):
+        # int dtype truncates coordinates, keep them on the grid
+        self.grid_origin = np.minimum([box['xmin'],box['ymin'],box['zmin']],xyz.min(axis=0)).astype(float)
+        if self.coord_step < 0:
+            extent = np.max(xyz.max(axis=0)-self.grid_origin)
+            self.coord_step = max(float(extent)/65535,1e-6)
+        return float(np.max(xyz.max(axis=0)-self.grid_origin))/self.coord_step < 65536
+
+    def quantization(self):
+        ret = {'exp_bits':self.exp_bits,'coord_step':self.coord_step}
+        if self.coord_step > 0:
+            ret['coord_origin'] = self.grid_origin.tolist()
+        return ret
+
+    def filename(self,basename,lod=None):
+        if lod is None:
+            return f'{basename}.{self.fmt}'
+        return f'{basename}.lod{lod}.{self.fmt}'
+
+def save_coords(xyz,prefix,conf):
+    filename = f'{prefix}/coords.{conf.fmt}'
+    if conf.fmt == 'bin':
+        savedata2bin(coord_columns(xyz,conf),filename)
+    else:
+        savedata2json(xyz,filename)
+
+# bin files come back as bytes, json files as data for iter_json so that
+# they can be written chunk by chunk
+def anno_data(xyz,annoids,conf,rows=None):
+    if conf.layout == 'index' and rows is None:
+        if conf.fmt == 'bin':
+            return data2bin(annoid_column(annoids))
+        return annoids
+    elif conf.layout == 'index':
+        annoids = annoids[rows]
+        if conf.fmt == 'bin':
+            return data2bin(delta_column(rows)+annoid_column(annoids))
+        return {'delta':np.diff(rows,prepend=0),'annoid':annoids}
+    if rows is not None:
+        xyz = xyz[rows]
+        annoids = annoids[rows]
+    if conf.fmt == 'bin':
+        return data2bin(coord_columns(xyz,conf)+annoid_column(annoids))
+    return JSONRows(*xyz.T,annoids)
+
+def gene_data(xyz,rows,exps,conf):
+    if conf.layout == 'index':
+        if conf.fmt == 'bin':
+            return data2bin(delta_column(rows)+exp_column(exps,conf))
+        return {'delta':np.diff(rows,prepend=0),'exp':exps}
+    xyz = xyz[rows]
+    if conf.fmt == 'bin':
+        return data2bin(coord_columns(xyz,conf)+exp_column(exps,conf))
+    return JSONRows(*xyz.T,exps)
+
+def payload(data):
+    if isinstance(data,bytes):
+        return data
+    return data2json(data)
+
+def save_payload(data,filename):
+    if not isinstance(data,bytes):
+        savedata2json(data,filename)
+        return
+    binfile = open(filename, "wb")
+    binfile.write(data)
+    binfile.close()
+
+def anno_payload(xyz,annoids,conf,rows=None):
+    return payload(anno_data(xyz,annoids,conf,rows))
+
+def save_anno(xyz,annoids,filename,conf,rows=None):
+    save_payload(anno_data(xyz,annoids,conf,rows),filename)
+
+def gene_payload(xyz,rows,exps,conf):
+    return payload(gene_data(xyz,rows,exps,conf))
+
+def save_gene_data(xyz,rows,exps,filename,conf):
+    save_payload(gene_data(xyz,rows,exps,conf),filename)
+
+#####################################################
+# level of detail
+#
+# every level keeps one cell per voxel of <binsize>; voxels are aligned to
+# the minimum corner of the cell coordinates (the box of getSummary).
+# Genes keep the highest expressed cell of each voxel, annotations the
+# first cell. Returns positions into rows, in ascending order.
+def lod_select(xyz,origin,binsize,rows,exps=None):
+    if len(rows) < 1:
+        return np.zeros(0,dtype=int)
+    voxels = ((xyz[rows]-origin)//binsize).astype('int64')
+    dims = voxels.max(axis=0)+1
+    keys = voxels[:,0] + dims[0]*(voxels[:,1] + dims[1]*voxels[:,2])
+    if exps is None:
+        _, first = np.unique(keys,return_index=True)
+    else:
+        order = np.lexsort((-exps,keys))
+        sorted_keys = keys[order]
+        first = order[np.r_[True,sorted_keys[1:] != sorted_keys[:-1]]]
+    return np.sort(first)
+
+#####################################################
+# octree chunks
+#
+# cells are split into an octree over summary['box'] until a leaf holds
+# at most leaf_size cells. octree.json lists every non-empty leaf with its
+# path of octants from the root, its bounds and its number of cells.
+def build_octree(xyz,box,leaf_size,max_depth=12):
+    # int dtype truncates coordinates, keep them inside the root node
+    lo = np.minimum([box['xmin'],box['ymin'],box['zmin']],xyz.min(axis=0)).astype(float)
+    hi = np.maximum([box['xmax'],box['ymax'],box['zmax']],xyz.max(axis=0)).astype(float)
+    leaves = []
+    leaf_of_cell = np.zeros(len(xyz),dtype='int32')
+    def split(rows,lo,hi,code):
+        if len(rows) < 1:
+            return
+        if len(rows) <= leaf_size or len(code) >= max_depth:
+            leaf_of_cell[rows] = len(leaves)
+            leaves.append({ 'id' : len(leaves),
+                            'code' : code,
+                            'box' : lo.tolist()+hi.tolist(),
+                            'cells' : len(rows) })
+            return
+        mid = (lo+hi)/2
+        p = xyz[rows]
+        octant = (p[:,0]>=mid[0]) + 2*(p[:,1]>=mid[1]) + 4*(p[:,2]>=mid[2])
+        for o in range(8):
+            upper = np.array([o&1,o&2,o&4]) > 0
+            split(rows[octant==o],np.where(upper,mid,lo),np.where(upper,hi,mid),code+[o])
+    split(np.arange(len(xyz)),lo,hi,[])
+    return leaf_of_cell, { 'box' : box, 'leaf_size' : leaf_size, 'nodes' : leaves }
+
+# chunk i of <name>.chunks.<fmt> is a standalone payload of the cells of
+# one leaf, stored in bytes [offset,offset+length); a client fetches the
+# leaves inside its view with HTTP range requests.
+def save_octree_chunks(basename,rows,conf,payload):
+    leaves = conf.octree[rows]
+    order = np.argsort(leaves,kind='stable')
+    leaves = leaves[order]
+    cuts = np.flatnonzero(np.r_[True,leaves[1:] != leaves[:-1],True])
+    index = []
+    offset = 0
+    chunkfile = open(f'{basename}.chunks.{conf.fmt}.tmp', "wb")
+    for start, end in zip(cuts[:-1],cuts[1:]):
+        data = payload(order[start:end])
+        chunkfile.write(data)
+        index.append([int(leaves[start]),offset,len(data),int(end-start)])
+        offset += len(data)
+    chunkfile.close()
+    savedata2json({'chunks':index},f'{basename}.octree.json.tmp')
+    os.replace(f'{basename}.chunks.{conf.fmt}.tmp',f'{basename}.chunks.{conf.fmt}')
+    os.replace(f'{basename}.octree.json.tmp',f'{basename}.octree.json')
+
+#####################################################
+# incremental rebuild
+#
+# manifest.json records, for every output file, the digest of all the
+# inputs it was generated from. An output is regenerated only if its
+# digest changes or the file is missing.
+def digest(*parts):
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part,np.ndarray):
+            part = np.ascontiguousarray(part)
+            h.update(f'{part.dtype.str}{part.shape}'.encode())
+            h.update(part.tobytes())
+        else:
+            h.update(str(part).encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+def file_digest(filename):
+    h = hashlib.sha1()
+    with open(filename,'rb') as f:
+        for block in iter(lambda: f.read(1<<20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class CacheManifest:
+    def __init__(self,prefix,force=False,resume=False):
+        self.prefix = prefix
+        self.filename = f'{prefix}/manifest.json'
+        self.resume = resume
+        self.files = {}
+        self.meshbox = None
+        if not force and os.path.isfile(self.filename):
+            data = json.load(open(self.filename))
+            self.files = data['files']
+            self.meshbox = data['meshbox']
+
+    def uptodate(self,relpath,hashcode):
+        if not os.path.isfile(f'{self.prefix}/{relpath}'):
+            return False
+        # resume mode trusts any file that exists
+        return self.resume or self.files.get(relpath) == hashcode
+
+    def update(self,relpath,hashcode):
+        self.files[relpath] = hashcode
+
+    def save(self):
+        savedata2json({'files':self.files,'meshbox':self.meshbox},f'{self.filename}.tmp')
+        os.replace(f'{self.filename}.tmp',self.filename)
+
+#####################################################
+# gene export engine
+#
+# worker side: coordinates of all cells are shipped once per worker
+_export_coords = None
+_export_conf = None
+
+def init_gene_worker(coords,conf):
+    global _export_coords, _export_conf
+    _export_coords = coords
+    _export_conf = conf
+
+def save_gene(task):
+    gene, rows, exps, basename, hashcode = task
+    conf = _export_conf
+    levels = []
+    for lod in conf.lods:
+        keep = lod_select(_export_coords,conf.origin,lod,rows,exps)
+        levels.append((conf.filename(basename,lod),rows[keep],exps[keep]))
+    if conf.octree is not None:
+        # positions into rows are kept ascending inside every leaf
+        save_octree_chunks(basename,rows,conf,
+            lambda keep: gene_payload(_export_coords,rows[keep],exps[keep],conf))
+    # the full level goes last and every file is written to a temporary
+    # name first, so that an interrupted run never leaves a truncated
+    # gene behind for --resume
+    levels.append((conf.filename(basename),rows,exps))
+    for filename, level_rows, level_exps in levels:
+        save_gene_data(_export_coords,level_rows,level_exps,f'{filename}.tmp',conf)
+        os.replace(f'{filename}.tmp', filename)
+    return gene, hashcode
+
+def gene_export_tasks(inh5ad, genes, prefix, conf, coords_hash, manifest, skipped):
+    # every gene is read once, for its hash and for its export
+    octree_hash = '' if conf.octree is None else digest(conf.octree)
+    for gene, rows, exps in inh5ad.getGeneSlices(genes):
+        hashcode = digest(conf.fmt,conf.layout,conf.lods,conf.exp_bits,octree_hash,coords_hash,rows,exps)
+        if manifest.uptodate(f'Gene/{gene}.{conf.fmt}',hashcode):
+            skipped.append(gene)
+            continue
+        yield gene, rows, exps, f'{prefix}/Gene/{gene}', hashcode
+
+def export_genes(inh5ad, genes, coords, coords_hash, prefix, conf, threads, manifest):
+    # gene files of index layout do not depend on coordinates
+    if conf.layout == 'index' and len(conf.lods) < 1 and conf.octree is None:
+        coords = None
+        coords_hash = ''
+    total = len(genes)
+    if total < 1:
+        return
+    skipped = []
+    tasks = gene_export_tasks(inh5ad, genes, prefix, conf, coords_hash, manifest, skipped)
+    step = max(1, total//20)
+    if threads < 2 or total < 2:
+        init_gene_worker(coords,conf)
+        done = map(save_gene, tasks)
+        pool = None
+    else:
+        from multiprocessing import Pool
+        pool = Pool(min(threads,total), initializer=init_gene_worker, initargs=(coords,conf))
+        done = pool.imap_unordered(save_gene, tasks, chunksize=8)
+    exported = 0
+    for gene, hashcode in done:
+        manifest.update(f'Gene/{gene}.{conf.fmt}',hashcode)
+        exported += 1
+        if exported % step == 0:
+            print(f'export gene {exported+len(skipped)}/{total} ...',flush=True)
+            manifest.save()
+    if pool is not None:
+        pool.close()
+        pool.join()
+    manifest.save()
+    print(f'exported {exported} genes, skipped {len(skipped)} up-to-date genes ...',flush=True)
+
+#####################################################
+# precompressed siblings
+#
+# LaunchAtlas serves <file>.br or <file>.gz with Content-Encoding
+# whenever the client accepts it and the sibling is not older than <file>.
+def compress_file(filename):
+    import gzip
+    data = open(filename,'rb').read()
+    out = [('.gz',gzip.compress(data,compresslevel=9,mtime=0))]
+    try:
+        import brotli
+        out.append(('.br',brotli.compress(data,quality=11)))
+    except ImportError:
+        pass
+    for ext, packed in out:
+        packfile = open(f'{filename}{ext}.tmp','wb')
+        packfile.write(packed)
+        packfile.close()
+        os.replace(f'{filename}{ext}.tmp',f'{filename}{ext}')
+    return filename
+
+def compress_folder(prefix,threads):
+    todo = []
+    for root, dirs, files in os.walk(prefix):
+        for name in files:
+            if name.endswith(('.gz','.br','.tmp')) or name == 'manifest.json':
+                continue
+            filename = os.path.join(root,name)
+            packfile = f'{filename}.gz'
+            if os.path.isfile(packfile) and os.path.getmtime(packfile) >= os.path.getmtime(filename):
+                continue
+            todo.append(filename)
+    print(f'compress {len(todo)} files ...',flush=True)
+    if len(todo) < 1:
+        return
+    if threads < 2:
+        for filename in todo:
+            compress_file(filename)
+    else:
+        from multiprocessing import Pool
+        with Pool(min(threads,len(todo))) as pool:
+            for _ in pool.imap_unordered(compress_file, todo, chunksize=8):
+                pass
+
 #####################################################
 # Usage
 #
@@ -48,6 +530,26 @@ Options:
             -c <conf.json>
             -o [output prefix, default webcace]
             -d [dtype of coord. default i (i/f int/float)]
+            -t [number of processes used to load meshes and export genes, default 8]
+            --resume [trust any Anno/Gene file already in the output folder]
+            --force [ignore manifest.json and regenerate every file]
+            --compress [also write .gz (and .br if brotli is installed) siblings of every file]
+            --backed [keep the expression matrix on disk and read only the gene columns in use]
+            --format [format of Anno and Gene files, default json (json/bin)]
+                     [bin: little-endian typed arrays behind a small json header]
+            --layout [layout of Anno and Gene files, default full (full/index)]
+                     [index: one shared coords file, Gene files hold only delta-encoded cell indices and values]
+            --lod [voxel sizes of coarse levels, default none, example: 40,20,10]
+                  [each level keeps one cell per voxel and is written as <name>.lod<size>.<fmt>]
+            --octree [max cells per octree leaf, default 0 (no octree chunks)]
+            --coord_step [grid step of uint16 coordinates in bin files, default 0 (no quantization)]
+                         [auto: box extent / 65535]
+            --exp_bits [bits of quantized expression in bin files, default 0 (float32) (8/16)]
+            --mesh_format [format of meshes, default json (json/bin)]
+                          [bin: one Mesh/<name>.bin of vertex and triangle buffers per mesh, listed in mesh.json]
+            --mesh_quantize [store vertices of bin meshes as uint16 within the box of every mesh]
+            --mesh_lod [target triangle counts of decimated meshes, default none, example: 20000,200000]
+                       [requires pyvista, written as meshes.lod<count>.json or Mesh/<name>.lod<count>.bin]
 Example:
         > vt3d AtlasBrowser BuildAtlas -i in.h5ad -c atlas.json
         > cat atlas.json
@@ -72,6 +574,23 @@ Example:
 
 Notice:
      Set "Genes" : ["all"] to export all genes in var.
+     Set --format bin to write Anno/*.bin and Gene/*.bin instead of .json files.
+     Set --layout index to write all cell coordinates once in coords.json (or coords.bin).
+     Set --lod to also write coarse levels that a client can fetch before the full files;
+     the voxel sizes are listed coarse first in summary.json.
+     Set --octree to also write <name>.chunks.<fmt>, the cells of each octree leaf as one
+     standalone chunk, with byte ranges in <name>.octree.json and leaves in octree.json.
+     Set --coord_step and/or --exp_bits (bin format only) to quantize bin files:
+     a column with "scale" and "base" in its header decodes as value = base + q * scale.
+     Coordinates snap to a grid of coord_step from the box origin (error <= coord_step/2);
+     expression keeps (2^exp_bits) levels between the min and max of every file
+     (error <= (max-min)/(2^exp_bits-1)/2). The settings are listed in summary.json.
+     Set --mesh_format bin to write Mesh/<name>.bin instead of one meshes.json so that meshes
+     can be loaded lazily and in parallel: a "position" column of deduplicated x,y,z vertices
+     and an "index" column of i,j,k triangles, each with its own count in the header.
+     Set --mesh_lod to also write quadric-decimated meshes that the browser can show first;
+     the triangle counts are listed coarse first in summary.json (and per mesh in mesh.json).
+     Parsed OBJ files are cached next to them as <mesh>.obj.npz and reused until the OBJ changes.
 
 The structure of output atlas folder:
       webcache
@@ -86,6 +605,11 @@ The structure of output atlas folder:
         +---summary.json
         +---gene.json
         +---meshes.json
+        +---manifest.json
+
+A rerun with the same output folder only regenerates the files whose
+inputs (expression, annotation, coordinate, dtype, format or mesh files)
+changed, as recorded in manifest.json.
 """, flush=True)
 
 #####################################################
@@ -98,8 +622,23 @@ def webcache_main(argv:[]):
     conf_file = ''
     prefix = 'webcache'
     dtype=int
+    threads = 8
+    resume = False
+    force = False
+    compress = False
+    backed = False
+    fmt = 'json'
+    layout = 'full'
+    lods = []
+    leaf_size = 0
+    coord_step = 0
+    exp_bits = 0
+    mesh_format = 'json'
+    mesh_quantize = False
+    mesh_lods = []
     try:
-        opts, args = getopt.getopt(argv,"hi:o:c:d:",["help"])
+        opts, args = getopt.getopt(argv,"hi:o:c:d:t:",["help","resume","force","compress","backed","format=","layout=","lod=","octree=",
+                                                      "coord_step=","exp_bits=","mesh_format=","mesh_quantize","mesh_lod="])
     except getopt.GetoptError:
         webcache_usage()
         sys.exit(2)
@@ -116,6 +655,34 @@ def webcache_main(argv:[]):
         elif opt in ("-d"):
             if arg == 'f':
                 dtype = float
+        elif opt in ("-t"):
+            threads = int(arg)
+        elif opt == "--resume":
+            resume = True
+        elif opt == "--force":
+            force = True
+        elif opt == "--compress":
+            compress = True
+        elif opt == "--backed":
+            backed = True
+        elif opt == "--format":
+            fmt = arg
+        elif opt == "--layout":
+            layout = arg
+        elif opt == "--lod":
+            lods = [ int(x) for x in arg.split(',') if x != '' ]
+        elif opt == "--octree":
+            leaf_size = int(arg)
+        elif opt == "--coord_step":
+            coord_step = -1 if arg == 'auto' else float(arg)
+        elif opt == "--exp_bits":
+            exp_bits = int(arg)
+        elif opt == "--mesh_format":
+            mesh_format = arg
+        elif opt == "--mesh_quantize":
+            mesh_quantize = True
+        elif opt == "--mesh_lod":
+            mesh_lods = sorted([ int(x) for x in arg.split(',') if x != '' ])
 
     #######################################
     # sanity check
@@ -123,6 +690,41 @@ def webcache_main(argv:[]):
         print('Error: incomplete parameters, exit ...')
         webcache_usage()
         sys.exit(2)
+    if not fmt in ('json','bin'):
+        print(f'Error: invalid format :{fmt}, exit ...')
+        webcache_usage()
+        sys.exit(2)
+    if not layout in ('full','index'):
+        print(f'Error: invalid layout :{layout}, exit ...')
+        webcache_usage()
+        sys.exit(2)
+    if len(lods) > 0 and min(lods) < 1:
+        print(f'Error: invalid lod :{lods}, exit ...')
+        webcache_usage()
+        sys.exit(2)
+    if not mesh_format in ('json','bin'):
+        print(f'Error: invalid mesh_format :{mesh_format}, exit ...')
+        webcache_usage()
+        sys.exit(2)
+    if len(mesh_lods) > 0 and min(mesh_lods) < 1:
+        print(f'Error: invalid mesh_lod :{mesh_lods}, exit ...')
+        webcache_usage()
+        sys.exit(2)
+    if len(mesh_lods) > 0:
+        try:
+            import pyvista
+        except ImportError:
+            print('Error: --mesh_lod requires pyvista, please pip install pyvista, exit ...',flush=True)
+            sys.exit(2)
+    if not exp_bits in (0,8,16):
+        print(f'Error: invalid exp_bits :{exp_bits}, exit ...')
+        webcache_usage()
+        sys.exit(2)
+    if fmt != 'bin' and (coord_step != 0 or exp_bits != 0):
+        print('Error: --coord_step and --exp_bits need --format bin, exit ...')
+        webcache_usage()
+        sys.exit(2)
+    cacheconf = CacheConf(fmt,layout,lods,coord_step,exp_bits)
 
     #######################################
     # load conf json and sanity check
@@ -147,7 +749,7 @@ def webcache_main(argv:[]):
 
     #######################################
     # load h5ad and sanity check
-    inh5ad = H5ADWrapper(inh5data)
+    inh5ad = H5ADWrapper(inh5data,backed)
     for annokey in confdata['Annotatinos']:
         if not inh5ad.hasAnno(annokey):
             print(f'Error: invalid Annotatino :{annokey}!' ,flush=True)
@@ -168,34 +770,106 @@ def webcache_main(argv:[]):
     create_folder(f'{prefix}')
     create_folder(f'{prefix}/Anno')
     create_folder(f'{prefix}/Gene')
+    manifest = CacheManifest(prefix,force,resume)
     #######################################
     # generate mesh json
     if len(confdata['Meshes'])>1:
        coord_file = confdata['mesh_coord']
        meshes = OBJWrapper(coord_file)
-       for meshname in confdata['Meshes']:
-           meshes.add_mesh(meshname,confdata['Meshes'][meshname]) 
-       savedata2json(meshes.get_data(),f'{prefix}/meshes.json')
+       coord_hash = file_digest(coord_file)
+       # one entry per mesh, so that bin meshes are rewritten one by one
+       mesh_hashes = { x : digest(coord_hash,x,file_digest(confdata['Meshes'][x]),mesh_format,mesh_quantize,mesh_lods)
+                       for x in confdata['Meshes'] }
+       mesh_hash = digest(*mesh_hashes.values())
+       mesh_file = 'meshes.json'
+       if mesh_format == 'bin':
+           mesh_file = 'mesh.json'
+       if manifest.uptodate(mesh_file,mesh_hash) and manifest.meshbox is not None:
+           print(f'{mesh_file} is up-to-date, skip ...',flush=True)
+           meshes.set_box(manifest.meshbox)
+       else:
+           meshes.add_meshes(confdata['Meshes'],threads)
+           if mesh_format == 'bin':
+               create_folder(f'{prefix}/Mesh')
+               reuse = {}
+               if os.path.isfile(f'{prefix}/mesh.json'):
+                   for entry in json.load(open(f'{prefix}/mesh.json'))['meshes']:
+                       name = entry['name']
+                       if not name in mesh_hashes:
+                           continue
+                       urls = [ x['url'] for x in entry['lods'] ]
+                       if manifest.uptodate(f'Mesh/{name}.bin',mesh_hashes[name]) and \
+                          all( os.path.isfile(f'{prefix}/{x}') for x in urls ):
+                           reuse[name] = entry
+               save_meshes(meshes,prefix,mesh_quantize,mesh_lods,reuse)
+               for name in mesh_hashes:
+                   manifest.update(f'Mesh/{name}.bin',mesh_hashes[name])
+           else:
+               for lod in mesh_lods:
+                   savedata2json(meshes.get_lod_data(lod),f'{prefix}/meshes.lod{lod}.json')
+               savedata2json(meshes.get_data(),f'{prefix}/meshes.json')
+           manifest.update(mesh_file,mesh_hash)
+           manifest.meshbox = meshes.get_box()
+           manifest.save()
     #######################################
     # generate summary and gene json
     summary = inh5ad.getSummary(confdata['Coordinate'] ,confdata['Annotatinos'] , confdata['Genes'])
     if len(confdata['Meshes'])>1:
         summary = meshes.update_summary(summary)
+    summary['format'] = fmt
+    summary['layout'] = layout
+    summary['lod'] = cacheconf.lods
+    summary['octree'] = leaf_size > 0
+    summary['mesh_format'] = mesh_format
+    summary['mesh_lod'] = mesh_lods
+    xyz = inh5ad.getBodyXYZ(confdata['Coordinate'],dtype).to_numpy()
+    coords_hash = digest(confdata['Coordinate'],xyz)
+    if coord_step != 0:
+        if not cacheconf.set_grid(xyz,summary['box']):
+            print(f'Error: coord_step {coord_step} is too small for uint16 coordinates, exit ...',flush=True)
+            sys.exit(2)
+        coords_hash = digest(coords_hash,cacheconf.quantization())
+        print(f'quantize coordinates with step {cacheconf.coord_step} ...',flush=True)
+    summary['quantization'] = cacheconf.quantization()
     #print(summary,flush=True)
     savedata2json(summary, f'{prefix}/summary.json')      
     savedata2json(confdata['Genes'],f'{prefix}/gene.json')
     #######################################
+    # generate shared coordinate table
+    cacheconf.origin = xyz.min(axis=0)
+    octree_hash = ''
+    if leaf_size > 0:
+        cacheconf.octree, octree = build_octree(xyz,summary['box'],leaf_size)
+        octree_hash = digest(cacheconf.octree)
+        print(f'octree with {len(octree["nodes"])} leaves ...',flush=True)
+        savedata2json(octree,f'{prefix}/octree.json')
+    if layout == 'index':
+        hashcode = digest(fmt,coords_hash)
+        if not manifest.uptodate(f'coords.{fmt}',hashcode):
+            save_coords(xyz,prefix,cacheconf)
+            manifest.update(f'coords.{fmt}',hashcode)
+    #######################################
     # generate annotation json
     for anno in confdata['Annotatinos']:
-        xyza = inh5ad.getCellXYZA(confdata['Coordinate'],dtype,anno)
         mapper = summary['annomapper'][f'{anno}_legend2int']
-        xyza['annoid'] = xyza.apply(lambda row : mapper[row['anno']],axis=1)
-        savedata2json(xyza[['x','y','z','annoid']].to_numpy().tolist(),f'{prefix}/Anno/{anno}.json')
+        annoids, _ = inh5ad.getAnnoCodes(anno,list(mapper.keys()))
+        use_coords = layout != 'index' or len(lods) > 0 or leaf_size > 0
+        hashcode = digest(fmt,layout,cacheconf.lods,octree_hash,coords_hash if use_coords else '',annoids)
+        if manifest.uptodate(f'Anno/{anno}.{fmt}',hashcode):
+            continue
+        if cacheconf.octree is not None:
+            save_octree_chunks(f'{prefix}/Anno/{anno}',np.arange(len(xyz)),cacheconf,
+                lambda keep: anno_payload(xyz,annoids,cacheconf,keep))
+        for lod in cacheconf.lods:
+            keep = lod_select(xyz,cacheconf.origin,lod,np.arange(len(xyz)))
+            save_anno(xyz,annoids,cacheconf.filename(f'{prefix}/Anno/{anno}',lod),cacheconf,keep)
+        save_anno(xyz,annoids,cacheconf.filename(f'{prefix}/Anno/{anno}'),cacheconf)
+        manifest.update(f'Anno/{anno}.{fmt}',hashcode)
+    manifest.save()
     #######################################
     # generate gene json
-    for gene in confdata['Genes']:
-        xyze = inh5ad.getGeneXYZE(gene,0,confdata['Coordinate'],dtype)
-        savedata2json(xyze.to_numpy().tolist(),f'{prefix}/Gene/{gene}.json')
+    export_genes(inh5ad,confdata['Genes'],xyz,coords_hash,prefix,cacheconf,threads,manifest)
+    manifest.save()
     #######################################
     # cp html and js
     base=os.path.dirname(os.path.realpath(__file__))
@@ -210,4 +884,7 @@ def webcache_main(argv:[]):
                'vendor.js.map',]
     for xx in flist:
         shutil.copyfile(f'{base}/{xx}', f'{prefix}/{xx}')
-
+    #######################################
+    # precompress for LaunchAtlas
+    if compress:
+        compress_folder(prefix,threads)
@@ -1,7 +1,14 @@
 #!/usr/bin/env python3
+import os
 import sys
 import getopt
 import json
+import threading
+import functools
+import numpy as np
+from io import BytesIO
+from urllib.parse import unquote, quote
+from collections import OrderedDict
 from http.server import *
 #####################################################
 # Usage
@@ -12,6 +19,31 @@ Usage : vt3d AtlasBrowser LaunchAtlas [options]
 
 Options:
             -p [port, default 80]
+            --max_age [seconds a client may reuse atlas files without revalidation, default 0]
+            --file_cache_mb [memory shared by all atlases to cache small files in MB, default 256, 0 to disable]
+
+       multi-atlas mode:
+            -r [folder whose sub-folders are atlases built by BuildAtlas]
+               [each atlas is served under /<sub-folder>/ and listed by /atlases.json]
+
+       on-demand gene mode:
+            -i [input.h5ad, answer /gene.json and /Gene/<gene> from this file instead of the cache folder]
+            -d [dtype of coord. default i (i/f int/float)]
+            --spatial_key [default 'spatial3D', the keyname of coordinate array in obsm]
+            --backed [keep the expression matrix on disk and read gene columns on request]
+            --cache_mb [memory bound of the gene LRU cache in MB, default 512]
+
+Notice:
+     .gz/.br files written by BuildAtlas --compress are served
+     automatically to clients that accept gzip/brotli encoding.
+     Requests are served concurrently with HTTP/1.1 keep-alive,
+     ETag/Last-Modified revalidation and byte-range support.
+     In multi-atlas mode, all atlases share one server process, one thread
+     pool and one file cache.
+     In on-demand gene mode, format and layout of gene payloads follow
+     the summary.json of the served folder.
+     Fast on-demand serving with --backed needs the .vt3d copy written by
+     vt3d Auxiliary Prepare, a CSR h5ad without it is scanned per gene.
 Example:
         > vt3d WebServer 
         
@@ -19,10 +51,279 @@ Example:
         never stop until you press Ctrl-C
 """, flush=True)
 
+def accepted_encodings(header):
+    ret = []
+    for item in header.split(','):
+        item = item.strip().split(';')
+        if item[0] == '':
+            continue
+        if len(item) > 1 and item[1].strip() in ('q=0','q=0.0','q=0.00','q=0.000'):
+            continue
+        ret.append(item[0].strip().lower())
+    return ret
+
+def parse_range(header, size):
+    # only a single 'bytes=start-end' range is supported,
+    # None means serve the whole file, () means unsatisfiable
+    if not header.startswith('bytes=') or ',' in header:
+        return None
+    start, sep, end = header[6:].strip().partition('-')
+    try:
+        if start == '':
+            if end == '':
+                return None
+            start = max(0, size-int(end))
+            end = size-1
+        else:
+            start = int(start)
+            end = size-1 if end == '' else min(int(end), size-1)
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        return ()
+    return start, end
+
+class RangeFile:
+    def __init__(self, f, start, length):
+        f.seek(start)
+        self.f = f
+        self.remain = length
+
+    def read(self, n=-1):
+        if n < 0 or n > self.remain:
+            n = self.remain
+        data = self.f.read(n)
+        self.remain -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+#####################################################
+# memory cache of small files, shared by all atlases
+#
+class FileCache:
+    def __init__(self, limit_mb):
+        self.limit = limit_mb*1024*1024
+        # one big file never evicts the whole cache
+        self.entry_limit = self.limit//16
+        self.cache = OrderedDict()
+        self.cache_size = 0
+        self.lock = threading.Lock()
+
+    def open(self, filename, fs):
+        if fs.st_size > self.entry_limit:
+            return open(filename, 'rb')
+        key = (filename, fs.st_size, fs.st_mtime_ns)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return BytesIO(self.cache[key])
+        payload = open(filename, 'rb').read()
+        with self.lock:
+            if not key in self.cache:
+                self.cache[key] = payload
+                self.cache_size += len(payload)
+            while self.cache_size > self.limit:
+                _, old = self.cache.popitem(last=False)
+                self.cache_size -= len(old)
+        return BytesIO(payload)
+
+def list_atlases(root):
+    ret = []
+    for name in sorted(os.listdir(root)):
+        summary_file = os.path.join(root, name, 'summary.json')
+        if not os.path.isfile(summary_file):
+            continue
+        ret.append({ 'name' : name,
+                     'url' : f'/{quote(name)}/index.html',
+                     'summary' : json.load(open(summary_file)) })
+    return ret
+
+#####################################################
+# on-demand gene payloads
+#
+class GeneProvider:
+    def __init__(self, h5ad, coord, dtype, conf, cache_mb, backed):
+        from vt3d_tools.h5ad_wrapper import H5ADWrapper
+        self.inh5ad = H5ADWrapper(h5ad,backed)
+        if not self.inh5ad.hasCoord(coord):
+            print(f'Error: invalid Coordinate :{coord}!' ,flush=True)
+            sys.exit(3)
+        self.conf = conf
+        self.coords = self.inh5ad.getBodyXYZ(coord,dtype).to_numpy()
+        self.gene_ids = self.inh5ad.GeneIndexMap()
+        self.genes = json.dumps(self.inh5ad.AllGenesList()).encode()
+        if not backed:
+            self.inh5ad.getExprCSC()
+        elif self.inh5ad.matrixEncoding().startswith('csr'):
+            # every gene request would scan the whole CSR matrix
+            print(f'WARN : {h5ad} stores X as CSR and has no prepared copy, each gene request scans the full matrix.',flush=True)
+            print(f'WARN : run vt3d Auxiliary Prepare -i {h5ad} first for fast on-demand serving.',flush=True)
+        self.cache = OrderedDict()
+        self.cache_size = 0
+        self.cache_limit = cache_mb*1024*1024
+        self.lock = threading.Lock()
+
+    def get(self, gene):
+        if not gene in self.gene_ids:
+            return None
+        with self.lock:
+            if gene in self.cache:
+                self.cache.move_to_end(gene)
+                return self.cache[gene]
+        from vt3d_tools.webcache import gene_payload
+        rows, exps = self.inh5ad.getGeneSlice(gene)
+        payload = gene_payload(self.coords,rows,exps,self.conf)
+        with self.lock:
+            if not gene in self.cache:
+                self.cache[gene] = payload
+                self.cache_size += len(payload)
+            while self.cache_size > self.cache_limit and len(self.cache) > 1:
+                _, old = self.cache.popitem(last=False)
+                self.cache_size -= len(old)
+        return payload
+
 class CORSRequestHandler (SimpleHTTPRequestHandler):
+    # keep connections alive between requests of one browser
+    protocol_version = 'HTTP/1.1'
+    # precompressed siblings written by BuildAtlas --compress, preferred first
+    encodings = [ ('br','.br'), ('gzip','.gz') ]
+    max_age = 0
+    gene_provider = None
+    file_cache = None
+    atlas_root = None
+
     def end_headers (self):
         self.send_header('Access-Control-Allow-Origin', '*')
         SimpleHTTPRequestHandler.end_headers(self)
+
+    def select_file(self, path):
+        # byte ranges always address the identity file, a slice of
+        # the compressed sibling would be garbage to the client
+        if 'Range' in self.headers:
+            return path, None
+        accepted = accepted_encodings(self.headers.get('Accept-Encoding',''))
+        for encoding, ext in self.encodings:
+            if not encoding in accepted or not os.path.isfile(path+ext):
+                continue
+            if os.path.getmtime(path+ext) < os.path.getmtime(path):
+                continue
+            return path+ext, encoding
+        return path, None
+
+    def not_modified(self, etag, mtime):
+        if 'If-None-Match' in self.headers:
+            tags = [ x.strip() for x in self.headers['If-None-Match'].split(',') ]
+            return etag in tags or '*' in tags
+        if 'If-Modified-Since' in self.headers and mtime is not None:
+            from email.utils import parsedate_to_datetime
+            try:
+                since = parsedate_to_datetime(self.headers['If-Modified-Since'])
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since.timestamp()
+        return False
+
+    def send_file_headers(self, path, etag, mtime, encoding):
+        self.send_header('Content-type', self.guess_type(path))
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(mtime))
+        self.send_header('Accept-Ranges', 'bytes')
+        # browser assets are requested as name.js?<hash>, never changing
+        if '?' in self.path:
+            self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+        else:
+            self.send_header('Cache-Control', f'public, max-age={self.max_age}')
+
+    def send_payload(self, path, payload):
+        import zlib
+        etag = f'"{len(payload):x}-{zlib.crc32(payload):08x}"'
+        if self.not_modified(etag, None):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return None
+        self.send_response(200)
+        self.send_header('Content-type', self.guess_type(path))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', f'public, max-age={self.max_age}')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        return BytesIO(payload)
+
+    def send_gene(self):
+        provider = self.gene_provider
+        path = unquote(self.path.split('?')[0].split('#')[0])
+        if path == '/gene.json':
+            return self.send_payload(path, provider.genes)
+        ext = f'.{provider.conf.fmt}'
+        if not path.startswith('/Gene/') or not path.endswith(ext):
+            return False
+        payload = provider.get(path[6:-len(ext)])
+        if payload is None:
+            self.send_error(404, "Gene not found")
+            return None
+        return self.send_payload(path, payload)
+
+    def send_head(self):
+        if self.atlas_root is not None and self.path.split('?')[0] == '/atlases.json':
+            return self.send_payload('/atlases.json', json.dumps(list_atlases(self.atlas_root)).encode())
+        if self.gene_provider is not None:
+            f = self.send_gene()
+            if f is not False:
+                return f
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path) or self.path.split('?')[0].endswith('/'):
+            return SimpleHTTPRequestHandler.send_head(self)
+        filename, encoding = self.select_file(path)
+        try:
+            fs = os.stat(filename)
+        except OSError:
+            self.send_error(404, "File not found")
+            return None
+        size = fs.st_size
+        etag = f'"{size:x}-{fs.st_mtime_ns:x}' + ('' if encoding is None else f'-{encoding}') + '"'
+        if self.not_modified(etag, fs.st_mtime):
+            self.send_response(304)
+            self.send_file_headers(path, etag, fs.st_mtime, encoding)
+            self.end_headers()
+            return None
+        byte_range = None
+        if 'Range' in self.headers:
+            if self.headers.get('If-Range', etag) == etag:
+                byte_range = parse_range(self.headers['Range'], size)
+        if byte_range == ():
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        try:
+            if self.file_cache is None:
+                f = open(filename, 'rb')
+            else:
+                f = self.file_cache.open(filename, fs)
+        except OSError:
+            self.send_error(404, "File not found")
+            return None
+        if byte_range is None:
+            self.send_response(200)
+            self.send_file_headers(path, etag, fs.st_mtime, encoding)
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            return f
+        start, end = byte_range
+        self.send_response(206)
+        self.send_file_headers(path, etag, fs.st_mtime, encoding)
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(end-start+1))
+        self.end_headers()
+        return RangeFile(f, start, end-start+1)
+
 #####################################################
 # main pipe
 #
@@ -30,9 +331,16 @@ def webserver_main(argv:[]):
     #######################################
     # default parameter value
     port = 8050
+    inh5data = ''
+    coord = 'spatial3D'
+    dtype = int
+    backed = False
+    cache_mb = 512
+    file_cache_mb = 256
+    atlas_root = ''
 
     try:
-        opts, args = getopt.getopt(argv,"hp:",["help"])
+        opts, args = getopt.getopt(argv,"hp:i:d:r:",["help","max_age=","spatial_key=","backed","cache_mb=","file_cache_mb="])
     except getopt.GetoptError:
         webserver_usage()
         sys.exit(2)
@@ -42,10 +350,59 @@ def webserver_main(argv:[]):
             sys.exit(0)
         elif opt in ("-p"):
             port = int(arg)
+        elif opt == "--max_age":
+            CORSRequestHandler.max_age = int(arg)
+        elif opt in ("-i"):
+            inh5data = arg
+        elif opt in ("-d"):
+            if arg == 'f':
+                dtype = float
+        elif opt == "--spatial_key":
+            coord = arg
+        elif opt == "--backed":
+            backed = True
+        elif opt == "--cache_mb":
+            cache_mb = int(arg)
+        elif opt == "--file_cache_mb":
+            file_cache_mb = int(arg)
+        elif opt in ("-r"):
+            atlas_root = arg
 
     # sanity check
+    if inh5data != '' and atlas_root != '':
+        print('Error: -i and -r can not be used together, exit ...',flush=True)
+        webserver_usage()
+        sys.exit(2)
+    if atlas_root != '':
+        if not os.path.isdir(atlas_root):
+            print(f'Error: invalid atlas folder :{atlas_root}!' ,flush=True)
+            sys.exit(3)
+        CORSRequestHandler.atlas_root = atlas_root
+        for atlas in list_atlases(atlas_root):
+            print(f'mount {atlas["name"]} at {atlas["url"]} ...',flush=True)
+    if file_cache_mb > 0:
+        CORSRequestHandler.file_cache = FileCache(file_cache_mb)
+    if inh5data != '':
+        if not os.path.isfile(inh5data):
+            print(f'Error: invalid input file :{inh5data}!' ,flush=True)
+            sys.exit(3)
+        from vt3d_tools.webcache import CacheConf
+        conf = CacheConf()
+        if os.path.isfile('summary.json'):
+            summary = json.load(open('summary.json'))
+            quant = summary.get('quantization',{})
+            conf = CacheConf(summary.get('format','json'),summary.get('layout','full'),[],
+                             quant.get('coord_step',0),quant.get('exp_bits',0))
+            if conf.coord_step > 0:
+                conf.grid_origin = np.array(quant['coord_origin'])
+        print(f'loading {inh5data} for on-demand genes ...',flush=True)
+        CORSRequestHandler.gene_provider = GeneProvider(inh5data,coord,dtype,conf,cache_mb,backed)
     # run server
     print(f'server run in port {port} now ...')
     server_address = ('', port)
-    httpd = HTTPServer(server_address, CORSRequestHandler)
+    if atlas_root != '':
+        handler = functools.partial(CORSRequestHandler, directory=atlas_root)
+    else:
+        handler = CORSRequestHandler
+    httpd = ThreadingHTTPServer(server_address, handler)
     httpd.serve_forever()